@@ -0,0 +1,135 @@
+"""Simulate the matcher to compare greedy first-fit scheduling with backfilling
+
+Run from the top of the repository so that the prominence package can be imported:
+
+    PYTHONPATH=. python benchmarks/backfill.py [JOBS [WORKERS]]
+"""
+import random
+import sys
+
+from prominence.placement import WorkerIndex, job_nodes, schedule
+
+# Simulated seconds between matcher cycles
+CYCLE = 60
+
+WORKER = {'cpus': 16, 'memory': 64, 'disk': 500}
+
+def generate(num_jobs, num_workers, load, seed=1):
+    """
+    Generate jobs arriving at random, mostly small single node jobs with some whole-node
+    and multi-node jobs. Jobs run for between 30% and 100% of their walltime
+    """
+    rng = random.Random(seed)
+    jobs = []
+    for i in range(num_jobs):
+        kind = rng.random()
+        if kind < 0.85:
+            cpus = rng.choice([1, 2, 4])
+            nodes = 1
+            walltime = rng.randint(10, 240)
+        elif kind < 0.95:
+            cpus = 16
+            nodes = 1
+            walltime = rng.randint(60, 480)
+        else:
+            cpus = 16
+            nodes = rng.choice([2, 4, 8])
+            walltime = rng.randint(60, 480)
+        jobs.append({'id': str(i),
+                     'resources': {'cpus': cpus, 'memory': cpus*4, 'disk': 10, 'nodes': nodes,
+                                   'walltime': walltime},
+                     'runtime': walltime*60*rng.uniform(0.3, 1.0)})
+
+    # Space arrivals so that the requested cpu time is the given fraction of capacity
+    work = sum(job['resources']['cpus']*job_nodes(job)*job['runtime'] for job in jobs)
+    duration = work/(load*num_workers*WORKER['cpus'])
+    for job in jobs:
+        job['submitted'] = rng.uniform(0, duration)
+    jobs.sort(key=lambda job: job['submitted'])
+    return jobs, duration
+
+def simulate(jobs, num_workers, reservations):
+    """
+    Run the matcher every cycle until all jobs have finished, backfilling with the given
+    number of reservations or greedily if there are none. Returns the wait time of each
+    job, the cpu time used and the time at which the last job finished
+    """
+    available = {'worker-%d' % i: dict(WORKER) for i in range(num_workers)}
+    index = WorkerIndex()
+    for name, resources in available.items():
+        index.add(name, resources)
+
+    arrivals = list(jobs)
+    pending = []
+    running = []
+    waits = {}
+    busy = 0
+    now = 0
+    while arrivals or pending or running:
+        for job, names, end, _ in [entry for entry in running if entry[2] <= now]:
+            for name in names:
+                index.release(name, job['resources'])
+        running = [entry for entry in running if entry[2] > now]
+
+        while arrivals and arrivals[0]['submitted'] <= now:
+            pending.append(arrivals.pop(0))
+
+        releases = None
+        if reservations:
+            releases = [(start + job['resources']['walltime']*60, name, job['resources'])
+                        for job, names, _, start in running
+                        for name in names]
+
+        assignments = schedule(pending, index, 'first-fit', releases=releases, now=now,
+                               reservations=reservations)
+        for job in pending:
+            if job['id'] in assignments:
+                waits[job['id']] = now - job['submitted']
+                running.append((job, assignments[job['id']], now + job['runtime'], now))
+                busy += job['resources']['cpus']*job_nodes(job)*job['runtime']
+        pending = [job for job in pending if job['id'] not in assignments]
+
+        now += CYCLE
+    return waits, busy, now
+
+def summary(jobs, waits, busy, makespan, num_workers):
+    """
+    Return utilisation and wait time statistics
+    """
+    def mean(values):
+        return sum(values)/len(values) if values else 0
+
+    all_waits = sorted(waits.values())
+    large = [waits[job['id']] for job in jobs if job['resources']['cpus']*job_nodes(job) >= 16]
+    multi = [waits[job['id']] for job in jobs if job_nodes(job) > 1]
+    return {'utilisation': busy/(makespan*num_workers*WORKER['cpus']),
+            'makespan': makespan/3600,
+            'mean': mean(all_waits)/60,
+            'p95': all_waits[int(0.95*(len(all_waits) - 1))]/60,
+            'large': mean(large)/60,
+            'multi': mean(multi)/60,
+            'max': all_waits[-1]/60}
+
+def main():
+    num_jobs = 5000
+    num_workers = 50
+    loads = [0.7, 0.9, 1.0]
+    if len(sys.argv) > 1:
+        num_jobs = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        num_workers = int(sys.argv[2])
+
+    print('%d jobs, %d workers, waits in minutes' % (num_jobs, num_workers))
+    print('%5s %10s %12s %9s %8s %8s %8s %8s %8s' % ('load', 'scheduler', 'utilisation', 'makespan',
+                                                   'mean', 'p95', 'large', 'multi', 'max'))
+    for load in loads:
+        jobs, _ = generate(num_jobs, num_workers, load)
+        for name, reservations in (('first-fit', 0), ('backfill', 1), ('backfill-2', 2)):
+            waits, busy, makespan = simulate(jobs, num_workers, reservations)
+            stats = summary(jobs, waits, busy, makespan, num_workers)
+            print('%5.1f %10s %11.1f%% %8.1fh %8.1f %8.1f %8.1f %8.1f %8.1f' % (
+                load, name, 100*stats['utilisation'], stats['makespan'], stats['mean'], stats['p95'],
+                stats['large'], stats['multi'], stats['max']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Benchmark matcher cycle time against queue and fleet size
+
+Run from the top of the repository so that the prominence package can be imported:
+
+    PYTHONPATH=. python benchmarks/placement.py [JOBSxWORKERS ...]
+"""
+import random
+import sys
+import time
+
+from prominence.placement import STRATEGIES, WorkerIndex, schedule
+
+JOB_SHAPES = [(1, 2, 10), (2, 4, 10), (4, 8, 20), (8, 16, 40), (16, 64, 100)]
+WORKER_SHAPES = [(8, 32, 200), (16, 64, 400), (32, 128, 800), (64, 256, 1600)]
+
+def generate(num_jobs, num_workers, seed=1):
+    """
+    Generate pending jobs and ready workers
+    """
+    rng = random.Random(seed)
+    jobs = []
+    for i in range(num_jobs):
+        cpus, memory, disk = rng.choice(JOB_SHAPES)
+        jobs.append({'id': str(i),
+                     'resources': {'cpus': cpus, 'memory': memory, 'disk': disk},
+                     'policies': {'priority': rng.randint(0, 3)}})
+    workers = []
+    for i in range(num_workers):
+        cpus, memory, disk = rng.choice(WORKER_SHAPES)
+        workers.append({'name': 'worker-%d' % i,
+                        'resources': {'available': {'cpus': cpus, 'memory': memory, 'disk': disk}}})
+    return jobs, workers
+
+def nested_loop(jobs, workers):
+    """
+    The original first-fit matcher, scanning every worker for every job
+    """
+    workers_resources = {}
+    for worker in workers:
+        workers_resources[worker['name']] = dict(worker['resources']['available'])
+
+    placed = 0
+    for job in jobs:
+        for worker in workers:
+            if (workers_resources[worker['name']]['cpus'] >= job['resources']['cpus'] and
+                workers_resources[worker['name']]['memory'] >= job['resources']['memory'] and
+                workers_resources[worker['name']]['disk'] >= job['resources']['disk']):
+                workers_resources[worker['name']]['cpus'] -= job['resources']['cpus']
+                workers_resources[worker['name']]['memory'] -= job['resources']['memory']
+                workers_resources[worker['name']]['disk'] -= job['resources']['disk']
+                placed += 1
+                break
+    return placed
+
+def indexed(jobs, workers, strategy):
+    """
+    The indexed scheduler used by bin/matcher.py
+    """
+    index = WorkerIndex()
+    for worker in workers:
+        index.add(worker['name'], dict(worker['resources']['available']))
+    return len(schedule(jobs, index, strategy))
+
+def main():
+    sizes = [(1000, 100), (10000, 1000), (50000, 2000)]
+    if len(sys.argv) > 1:
+        sizes = [tuple(int(value) for value in size.split('x')) for size in sys.argv[1:]]
+
+    print('%8s %8s %12s %10s %8s' % ('jobs', 'workers', 'matcher', 'secs', 'placed'))
+    for num_jobs, num_workers in sizes:
+        jobs, workers = generate(num_jobs, num_workers)
+
+        start_time = time.time()
+        placed = nested_loop(jobs, workers)
+        print('%8d %8d %12s %10.3f %8d' % (num_jobs, num_workers, 'nested-loop', time.time() - start_time, placed))
+
+        for strategy in STRATEGIES:
+            start_time = time.time()
+            placed = indexed(jobs, workers, strategy)
+            print('%8d %8d %12s %10.3f %8d' % (num_jobs, num_workers, strategy, time.time() - start_time, placed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Benchmark serializing job listings with and without response validation"""
+import json
+import random
+import sys
+import time
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+from prominence.models import JobOutput
+from prominence.serialization import prune_job
+
+def generate(num_jobs, seed=1):
+    """
+    Generate jobs as stored in the database
+    """
+    rng = random.Random(seed)
+    jobs = []
+    for i in range(num_jobs):
+        jobs.append({
+            '_key': str(i), '_id': f"jobs/{i}", '_rev': '_abc',
+            'id': str(i),
+            'name': f"job-{i}",
+            'status': rng.choice(['pending', 'running', 'completed']),
+            'created': 1700000000.0 + i,
+            'tasks': [{'image': 'centos:7', 'runtime': 'singularity', 'cmd': 'sleep 100',
+                       'env': {'A': str(i)}, 'workdir': None, 'procsPerNode': None}],
+            'resources': {'cpus': 1, 'memory': 1, 'disk': 10, 'nodes': 1, 'walltime': 60},
+            'artifacts': None,
+            'policies': {'maximumRetries': 0, 'maximumTaskRetries': 0, 'maximumTimeInQueue': 0, 'priority': 0},
+            'events': [{'time': 1700000000.0 + i, 'type': 'created'},
+                       {'time': 1700000010.0 + i, 'type': 'started'}],
+            'execution': {'retries': 0, 'worker': 'worker-1', 'site': 'site-1',
+                          'cpu': {'clock': '2400', 'model': 'Xeon', 'vendor': 'Intel'},
+                          'tasks': [{'exitCode': 0, 'retries': 0, 'imagePullStatus': 'cached',
+                                     'imagePullTime': 1.5, 'wallTimeUsage': 100.0, 'cpuTimeUsage': 99.0,
+                                     'maxResidentSetSizeKB': 1024}]},
+        })
+    return jobs
+
+def validated(jobs):
+    """
+    Validate against the response model and encode, as FastAPI does with response_model
+    and response_model_exclude_none
+    """
+    models = [JobOutput.parse_obj(job) for job in jobs]
+    return json.dumps(jsonable_encoder(models, exclude_none=True)).encode('utf-8')
+
+def fast(jobs):
+    """
+    Prune trusted jobs and encode with orjson
+    """
+    return orjson.dumps([prune_job(job) for job in jobs])
+
+def main():
+    sizes = [1000, 10000, 100000]
+    if len(sys.argv) > 1:
+        sizes = [int(size) for size in sys.argv[1:]]
+
+    print('%8s %12s %12s %8s' % ('jobs', 'validated', 'fast', 'speedup'))
+    for num_jobs in sizes:
+        jobs = generate(num_jobs)
+
+        start_time = time.time()
+        slow_output = validated(jobs)
+        slow_time = time.time() - start_time
+
+        start_time = time.time()
+        fast_output = fast(jobs)
+        fast_time = time.time() - start_time
+
+        assert json.loads(slow_output) == json.loads(fast_output)
+        print('%8d %12.3f %12.3f %7.1fx' % (num_jobs, slow_time, fast_time, slow_time / fast_time))
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 """Update job status when needed"""
 import asyncio
+import itertools
 import json
 import signal
 import sys
@@ -8,39 +9,40 @@ import time
 import nats
 
 from prominence.database import Database
-from prominence.utilities import config, set_logger
+from prominence.messaging import ensure_status_stream, publish, status_change
+from prominence.settings import reload_on_sighup, settings
+from prominence.utilities import set_logger
 
-logger = set_logger(config().get('job_handler', 'log'))
+logger = set_logger(settings().job_handler.log)
 
-def update_job_start(job, data):
-    """
-    Update job details
-    """
-    if 'execution' not in job:
-        job['execution'] = {}
-
-    job['execution']['worker'] = data['worker']
+db = Database()
 
-    return job
+# Job status and event type for each event sent by workers
+EVENTS = {
+    'start': ('running', 'started'),
+    'success': ('completed', 'completed'),
+    'failed': ('failed', 'failed'),
+    'killed': ('killed', 'killed'),
+    'deleted': ('deleted', 'deleted'),
+}
 
-def update_job(job, data):
+def execution_details(data):
     """
-    Update job details for a job in a terminal state
+    Return the execution details reported in an event
     """
-    if 'execution' not in job:
-        job['execution'] = {}
+    execution = {}
 
     if 'worker' in data:
-        job['execution']['worker'] = data['worker']
+        execution['worker'] = data['worker']
 
     if 'details' in data:
         if 'site' in data['details']:
-            job['execution']['site'] = data['details']['site']
+            execution['site'] = data['details']['site']
         if 'cpu_vendor' in data['details'] and 'cpu_model' in data['details'] and 'cpu_clock' in data['details']:
-            job['execution']['cpu'] = {}
-            job['execution']['cpu']['clock'] = data['details']['cpu_clock']
-            job['execution']['cpu']['model'] = data['details']['cpu_model']
-            job['execution']['cpu']['vendor'] = data['details']['cpu_vendor']
+            execution['cpu'] = {}
+            execution['cpu']['clock'] = data['details']['cpu_clock']
+            execution['cpu']['model'] = data['details']['cpu_model']
+            execution['cpu']['vendor'] = data['details']['cpu_vendor']
         tasks = []
         if 'tasks' in data['details']:
             if data['details']['tasks']:
@@ -48,52 +50,198 @@ def update_job(job, data):
                     if 'exitCode' in task:
                         tasks.append(task)
         if tasks:
-            job['execution']['tasks'] = tasks
+            execution['tasks'] = tasks
+
+    return execution
+
+def apply_events(events):
+    """
+    Apply the events for a job, in the order they were sent, using a single database update
+    for each run of events from the same worker. Returns the resulting status change, if any
+    """
+    events = [data for data in events if data['event'] in EVENTS]
+    change = None
+    for _, run in itertools.groupby(events, key=lambda data: data.get('worker')):
+        change = apply_worker_events(list(run)) or change
+    return change
+
+def apply_worker_events(events):
+    """
+    Apply events for a job sent by a single worker. Events from a worker which the job is
+    no longer assigned to are ignored. Returns the resulting status change, if any
+    """
+    id = events[0]['id']
+    worker = events[0].get('worker')
+    job_events = []
+    execution = {}
+    for data in events:
+        status, event = EVENTS[data['event']]
+        job_events.append({'time': data['epoch'], 'type': event})
+        execution.update(execution_details(data))
 
-    return job
+    # Jobs which did not succeed are retried if their policies allow it
+    job, applied = db.update_job(id,
+                                 status,
+                                 job_events,
+                                 execution,
+                                 retry=events[-1]['event'] in ('failed', 'killed', 'deleted'),
+                                 worker=worker)
+    if not job:
+        logger.error('Job %s does not exist', id)
+        return None
+    elif not applied:
+        logger.info('Ignoring events for job %s from worker %s, which it is no longer assigned to',
+                    id, worker)
+        return None
+    logger.info('Job %s status set to %s', id, status)
+    if job['status'] != status:
+        logger.info('Job %s will be retried', id)
+    return status_change(id, job['status'], events[-1]['epoch'])
 
 def subscribe_handler(data):
     data = json.loads(data)
     logger.info('Updating job %s', data['id'])
 
-    db = Database()
-    job = db.get_job(data['id'], False)
-
-    if data['event'] == 'start':
-        logger.info('Job %s status set to running', data['id'])
-        job['events'].append({'time': data['epoch'], 'type': 'started'})
-        job['status'] = 'running'
-        job = update_job(job, data)
-        job.save()
-    elif data['event'] == 'success':
-        logger.info('Job %s status set to completed', data['id'])
-        job['events'].append({'time': data['epoch'], 'type': 'completed'})
-        job['status'] = 'completed'
-        job = update_job(job, data)
-        job.save()
-    elif data['event'] in ('failed', 'killed', 'deleted'):
-        logger.info('Job %s status set to %s', data['id'], data['event'])
-        job['events'].append({'time': data['epoch'], 'type': data['event']})
-        job['status'] = data['event']
-        job = update_job(job, data)
-
-        # Handle job retries
-        maximum_retries = 0
-        retries = 0
-        if 'policies' in job:
-            if job['policies']:
-                if 'maximumRetries' in job['policies']:
-                    maximum_retries = job['policies']['maximumRetries']
-        if 'execution' in job:
-            if job['execution']:
-                if 'retries' in job['execution']:
-                    retries = job['execution']['retries']
-
-        if maximum_retries > 0 and retries < maximum_retries:
-            job['status'] = 'pending'
-            job['events'].append({'time': time.time(), 'type': 'retrying'})
-
-        job.save()
+    if data['event'] not in EVENTS:
+        logger.info('Ignoring unknown event %s for job %s', data['event'], data['id'])
+        return None
+
+    return apply_events([data])
+
+async def publish_status_changes(nc, changes):
+    """
+    Publish changes of job status, which are only informational so failures are logged
+    """
+    changes = [change for change in changes if change]
+    if not changes:
+        return
+    try:
+        await publish(nc, changes)
+    except Exception as err:
+        logger.error('Got exception publishing status changes: %s', str(err))
+
+async def consumer_config(js, durable, previous, config):
+    """
+    Return the configuration for a durable consumer of events. If the consumer does not
+    exist yet but the consumer used by the other mode does, the new consumer starts just
+    after the last event the other consumer had acked, so that no events are lost when
+    switching between modes
+    """
+    stream = await js.find_stream_name_by_subject("jobs.*.events")
+    try:
+        await js.consumer_info(stream, durable)
+        return config
+    except nats.js.errors.NotFoundError:
+        pass
+    try:
+        info = await js.consumer_info(stream, previous)
+    except nats.js.errors.NotFoundError:
+        return config
+    logger.info('Starting consumer %s after event %d acked by consumer %s',
+                durable, info.ack_floor.stream_seq, previous)
+    config.deliver_policy = nats.js.api.DeliverPolicy.BY_START_SEQUENCE
+    config.opt_start_seq = info.ack_floor.stream_seq + 1
+    return config
+
+async def remove_consumer(js, durable):
+    """
+    Delete the consumer of events used by the other mode, so that switching back to it
+    later starts from where this mode left off rather than from where it stopped
+    """
+    try:
+        stream = await js.find_stream_name_by_subject("jobs.*.events")
+        await js.delete_consumer(stream, durable)
+        logger.info('Deleted consumer %s', durable)
+    except nats.js.errors.NotFoundError:
+        pass
+
+async def consume_batches(nc, js):
+    """
+    Fetch events in batches and process them concurrently, partitioned by job so that the
+    events for each job are applied in order. Messages are acked once their update has
+    been written. If the events for a job cannot be applied they are redelivered after a
+    delay, and any later events for the job are held back until they have been applied
+    """
+    batch_size = settings().job_handler.batch_size
+    num_tasks = settings().job_handler.tasks
+
+    # Only deliver new events when the consumer is first created, rather than the whole
+    # stream, unless taking over from the push consumer
+    config = await consumer_config(js,
+                                   "job-handler-batch",
+                                   "job-handler",
+                                   nats.js.api.ConsumerConfig(deliver_policy=nats.js.api.DeliverPolicy.NEW))
+    sub = await js.pull_subscribe("jobs.*.events", durable="job-handler-batch", config=config)
+    await remove_consumer(js, "job-handler")
+
+    async def report_lag():
+        interval = settings().job_handler.lag_interval
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                info = await sub.consumer_info()
+                logger.info('Consumer lag: %d events pending, %d awaiting ack',
+                            info.num_pending, info.num_ack_pending)
+            except Exception as err:
+                logger.error('Got exception getting consumer info: %s', str(err))
+
+    # Jobs with events which could not be applied, with the stream sequence of the
+    # earliest of them
+    blocked = {}
+
+    def sequence(msg):
+        return msg.metadata.sequence.stream
+
+    async def process(jobs):
+        changes = []
+        delay = settings().job_handler.retry_delay
+        for messages in jobs:
+            id = messages[0][1]['id']
+            # Redelivered events can arrive in the same batch as later ones
+            messages.sort(key=lambda message: sequence(message[0]))
+            if id in blocked and sequence(messages[0][0]) > blocked[id]:
+                for msg, _ in messages:
+                    await msg.nak(delay=delay)
+                continue
+            try:
+                changes.append(await asyncio.to_thread(apply_events, [data for _, data in messages]))
+            except Exception as err:
+                logger.error('Got exception updating job %s: %s', id, str(err))
+                blocked[id] = sequence(messages[0][0])
+                for msg, _ in messages:
+                    await msg.nak(delay=delay)
+                continue
+            blocked.pop(id, None)
+            for msg, _ in messages:
+                await msg.ack()
+        await publish_status_changes(nc, changes)
+
+    asyncio.create_task(report_lag())
+
+    while True:
+        try:
+            msgs = await sub.fetch(batch_size, timeout=5)
+        except nats.errors.TimeoutError:
+            continue
+        except Exception as err:
+            logger.error('Got exception fetching events: %s', str(err))
+            await asyncio.sleep(1)
+            continue
+
+        jobs = {}
+        for msg in msgs:
+            try:
+                data = json.loads(msg.data.decode())
+                jobs.setdefault(data['id'], []).append((msg, data))
+            except Exception as err:
+                logger.error('Got invalid event: %s', str(err))
+                await msg.term()
+
+        partitions = [[] for _ in range(num_tasks)]
+        for id, messages in jobs.items():
+            partitions[hash(id) % num_tasks].append(messages)
+
+        await asyncio.gather(*[process(partition) for partition in partitions if partition])
 
 async def run():
     async def error_cb(err):
@@ -110,7 +258,7 @@ async def run():
 
     nc = None
     try:
-        nc = await nats.connect(config().get('nats', 'url'),
+        nc = await nats.connect(settings().nats.url,
                                 max_reconnect_attempts=-1,
                                 disconnected_cb=disconnected_cb,
                                 reconnected_cb=reconnected_cb,
@@ -128,13 +276,25 @@ async def run():
         asyncio.get_running_loop().add_signal_handler(getattr(signal, sig), signal_handler)
 
     js = nc.jetstream()
-    sub = await js.subscribe("jobs.*.events", durable="job-handler")
+
+    try:
+        await ensure_status_stream(nc)
+    except Exception as err:
+        logger.error('Got exception creating status stream: %s', str(err))
+
+    if settings().job_handler.consumer == 'batch':
+        await consume_batches(nc, js)
+
+    config = await consumer_config(js, "job-handler", "job-handler-batch", nats.js.api.ConsumerConfig())
+    sub = await js.subscribe("jobs.*.events", durable="job-handler", config=config)
+    await remove_consumer(js, "job-handler-batch")
 
     while True:
         try:
             msg = await sub.next_msg()
+            change = subscribe_handler(msg.data.decode())
             await msg.ack()
-            subscribe_handler(msg.data.decode())
+            await publish_status_changes(nc, [change])
         except Exception as err:
             if 'timeout' not in str(err):
                 logger.error(str(err))
@@ -143,6 +303,7 @@ async def run():
     await nc.close()
 
 def main():
+    reload_on_sighup()
     loop = asyncio.get_event_loop()
     loop.run_until_complete(run())
     try:
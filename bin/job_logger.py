@@ -1,18 +1,137 @@
 import asyncio
+import json
 import signal
 import sys
+from collections import OrderedDict
 
 import nats
 
-from prominence.utilities import config, set_logger
-
-logger = set_logger(config().get('job_logger', 'log').replace('type', sys.argv[1]))
-
-def write_log(msg):
-    subject = msg.subject
-    data = msg.data.decode()
-    with open(f"{config().get('job_logger', 'directory')}/{subject}", 'a') as fh:
-        fh.write(data)
+from prominence.logs import OFFSET_HEADER, relay_subject
+from prominence.logstore import LogStore
+from prominence.settings import reload_on_sighup, settings
+from prominence.utilities import set_logger
+
+logger = set_logger(settings().job_logger.log.replace('type', sys.argv[1]))
+
+# Events after which a job will not write any more output
+TERMINAL_EVENTS = ('success', 'failed', 'killed', 'deleted')
+
+class LogWriter(object):
+    """
+    Write one stream of job output to per-job logs, keeping the most recently used logs
+    open and buffering writes. Messages are only acked once their data has been flushed.
+    Flushed output is relayed to followers together with its offset in the log
+    """
+    def __init__(self, nc, store, stream, max_open_files, buffer_size, max_pending):
+        self._nc = nc
+        self._store = store
+        self._stream = stream
+        self._max_open_files = max_open_files
+        self._buffer_size = buffer_size
+        self._max_pending = max_pending
+        self._logs = OrderedDict()
+        self._buffers = {}
+        self._size = 0
+        self._messages = []
+        self._lock = asyncio.Lock()
+
+    def _open(self, subject):
+        """
+        Return an open log for a subject, closing the least recently used log if necessary
+        """
+        if subject in self._logs:
+            self._logs.move_to_end(subject)
+            return self._logs[subject]
+
+        if len(self._logs) >= self._max_open_files:
+            _, log = self._logs.popitem(last=False)
+            log.close()
+
+        _, id, stream = subject.split('.', 2)
+        log = self._store.open(id, stream)
+        self._logs[subject] = log
+        return log
+
+    async def write(self, msg):
+        """
+        Buffer the data in a message, flushing if the buffer is full or if so many messages
+        are waiting to be acked that the server would soon stop delivering more
+        """
+        self._buffers.setdefault(msg.subject, []).append(msg.data)
+        self._size += len(msg.data)
+        self._messages.append(msg)
+        if self._size >= self._buffer_size or len(self._messages) >= self._max_pending//2:
+            await self.flush()
+
+    async def flush(self):
+        """
+        Write all buffered data to disk and ack the corresponding messages
+        """
+        async with self._lock:
+            buffers = self._buffers
+            messages = self._messages
+            self._buffers = {}
+            self._messages = []
+            self._size = 0
+
+            written = []
+            for subject, chunks in buffers.items():
+                log = self._open(subject)
+                data = b''.join(chunks)
+                offset = log.size
+                log.write(data)
+                log.flush()
+                if log.size > offset:
+                    written.append((subject.split('.')[1], offset, data[:log.size - offset]))
+
+            for msg in messages:
+                await msg.ack()
+
+            for id, offset, data in written:
+                await self._relay(id, offset, data)
+
+    async def _relay(self, id, offset, data):
+        """
+        Relay output written to the log of a job at the given offset to followers
+        """
+        try:
+            await self._nc.publish(relay_subject(id, self._stream),
+                                   data,
+                                   headers={OFFSET_HEADER: str(offset)})
+        except Exception as err:
+            logger.error('Got exception relaying output of job %s: %s', id, str(err))
+
+    async def flush_periodically(self, interval):
+        """
+        Flush at the given interval
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as err:
+                logger.error('Got exception flushing: %s', str(err))
+
+    async def close_job(self, id):
+        """
+        Flush and close the log of a job, telling followers where its output ends
+        """
+        await self.flush()
+        log = self._logs.pop(f"jobs.{id}.{self._stream}", None)
+        if log:
+            size = log.size
+            log.close()
+        else:
+            size = await asyncio.to_thread(self._store.size, id, self._stream)
+        await self._relay(id, size, b'')
+
+    def close(self):
+        """
+        Close all logs
+        """
+        while self._logs:
+            _, log = self._logs.popitem()
+            log.close()
 
 async def run():
     async def error_cb(err):
@@ -29,7 +148,7 @@ async def run():
 
     nc = None
     try:
-        nc = await nats.connect(config().get('nats', 'url'),
+        nc = await nats.connect(settings().nats.url,
                                 max_reconnect_attempts=-1,
                                 disconnected_cb=disconnected_cb,
                                 reconnected_cb=reconnected_cb,
@@ -38,22 +157,52 @@ async def run():
     except Exception as err:
         logger.error('Got exception connecting to NATS: %s', str(err))
 
+    job_logger = settings().job_logger
+    store = LogStore(job_logger.directory,
+                     job_logger.segment_size,
+                     job_logger.max_size,
+                     job_logger.compression_level)
+    writer = LogWriter(nc,
+                       store,
+                       sys.argv[1],
+                       job_logger.max_open_files,
+                       job_logger.buffer_size,
+                       job_logger.max_ack_pending)
+
+    async def shutdown():
+        await writer.flush()
+        writer.close()
+        await nc.drain()
+
     def signal_handler():
         if nc.is_closed:
             return
-        asyncio.create_task(nc.drain())
+        asyncio.create_task(shutdown())
 
     for sig in ('SIGINT', 'SIGTERM'):
         asyncio.get_running_loop().add_signal_handler(getattr(signal, sig), signal_handler)
 
+    async def events_handler(msg):
+        try:
+            data = json.loads(msg.data.decode())
+            if data['event'] in TERMINAL_EVENTS:
+                await writer.close_job(data['id'])
+        except Exception as err:
+            logger.error('Got exception handling event: %s', str(err))
+
+    await nc.subscribe("jobs.*.events", cb=events_handler)
+
+    asyncio.create_task(writer.flush_periodically(job_logger.flush_interval))
+
     js = nc.jetstream()
-    sub = await js.subscribe(f"jobs.*.{sys.argv[1]}", durable=f"job-{sys.argv[1]}-handler")
+    sub = await js.subscribe(f"jobs.*.{sys.argv[1]}",
+                             durable=f"job-{sys.argv[1]}-handler",
+                             config=nats.js.api.ConsumerConfig(max_ack_pending=job_logger.max_ack_pending))
 
     while True:
         try:
             msg = await sub.next_msg()
-            await msg.ack()
-            write_log(msg)
+            await writer.write(msg)
         except Exception as err:
             if 'timeout' not in str(err):
                 logger.error(str(err))
@@ -63,6 +212,7 @@ async def run():
 
 
 def main():
+    reload_on_sighup()
     loop = asyncio.get_event_loop()
     loop.run_until_complete(run())
     try:
@@ -6,42 +6,35 @@ import time
 import nats
 
 from prominence.database import Database
-from prominence.utilities import config, set_logger
+from prominence.messaging import ensure_status_stream, publish, status_change
+from prominence.partitions import PartitionLeases, leases_bucket
+from prominence.placement import TieredWorkerIndex, job_images, job_walltime, schedule
+from prominence.settings import reload_on_sighup, settings
+from prominence.utilities import set_logger
 
-logger = set_logger(config().get('matcher', 'log'))
+logger = set_logger(settings().matcher.log)
 
 db = Database()
 
-async def matcher():
-    """
-    Match idle jobs to workers
-    """
-    async def error_cb(err):
-        logger.error(err)
-
-    async def disconnected_cb():
-        logger.error('Got disconnected from NATS')
+async def error_cb(err):
+    logger.error(err)
 
-    async def reconnected_cb():
-        logger.error('Got reconnected to NATS')
+async def disconnected_cb():
+    logger.error('Got disconnected from NATS')
 
-    async def closed_cb():
-        logger.error('Stopped reconnection to NATS')
+async def reconnected_cb():
+    logger.error('Got reconnected to NATS')
 
-    logger.info('Starting matching...')
-    start_time = time.time()
+async def closed_cb():
+    logger.error('Stopped reconnection to NATS')
 
-    logger.info('Getting idle jobs...')
-    jobs = db.get_pending_jobs()
-    idle_jobs = []
-    for job in jobs:
-        idle_jobs.append(job)
-    logger.info('There are %d idle jobs', len(idle_jobs))
-
-    logger.info('Getting workers...')
+async def connect():
+    """
+    Connect to NATS
+    """
     nc = None
     try:
-        nc = await nats.connect(config().get('nats', 'url'),
+        nc = await nats.connect(settings().nats.url,
                                 max_reconnect_attempts=-1,
                                 disconnected_cb=disconnected_cb,
                                 reconnected_cb=reconnected_cb,
@@ -51,50 +44,499 @@ async def matcher():
         logger.error('Got exception connecting to NATS: %s', str(err))
         sys.exit(1)
 
-    async def send(id, job):
-        data = json.dumps(job).encode('utf-8')
-        await nc.publish("worker.job.%s" % id, data)
+    try:
+        await ensure_status_stream(nc)
+    except Exception as err:
+        logger.error('Got exception creating status stream: %s', str(err))
 
-    js = nc.jetstream()
-    kv = await js.key_value(bucket=config().get('nats', 'workers_bucket'))
+    return nc
+
+def get_idle_jobs(leases):
+    """
+    Return all pending jobs in the partitions owned from the database
+    """
+    idle_jobs = []
+    for job in db.get_pending_jobs(leases.partitions, leases.owned):
+        idle_jobs.append(job)
+    return idle_jobs
+
+async def get_workers(kv):
+    """
+    Return all ready workers from the workers bucket, fetching them concurrently. Workers
+    are not partitioned, since every matcher must be able to place its jobs anywhere
+    """
     worker_ids = []
     try:
         worker_ids = await kv.keys()
     except:
         logger.info('No workers found')
+
+    semaphore = asyncio.Semaphore(settings().matcher.kv_concurrency)
+
+    async def get(worker):
+        async with semaphore:
+            try:
+                entry = await kv.get(worker)
+                return json.loads(entry.value)
+            except:
+                return None
+
     workers = []
-    workers_resources = {}
-    for worker in worker_ids:
+    for worker in await asyncio.gather(*[get(worker) for worker in worker_ids]):
+        if worker and worker['status'] == 'ready':
+            workers.append(worker)
+    return workers
+
+async def get_workers_timed(kv):
+    """
+    Return all ready workers, logging how long loading the snapshot took
+    """
+    start_time = time.time()
+    workers = await get_workers(kv)
+    logger.info('Loaded %d workers in %f secs', len(workers), time.time() - start_time)
+    return workers
+
+_pull_times = {}
+_pull_times_loaded = 0
+
+def get_pull_times():
+    """
+    Return the average time taken to pull each image, refreshed periodically
+    """
+    global _pull_times, _pull_times_loaded
+    if time.time() - _pull_times_loaded > settings().matcher.pull_times_interval:
         try:
-            entry = await kv.get(worker)
-            worker = json.loads(entry.value)
-            if worker['status'] == 'ready':
-                workers.append(worker)
-                workers_resources[worker['name']] = worker['resources']['available']
-        except:
-            pass
+            _pull_times = db.image_pull_times()
+        except Exception as err:
+            logger.error('Got exception getting image pull times: %s', str(err))
+        _pull_times_loaded = time.time()
+    return _pull_times
+
+def get_releases():
+    """
+    Return the time at which each node of every assigned or running job is expected to
+    end, the worker it is on and the resources it will release
+    """
+    releases = []
+    for job in db.get_active_jobs():
+        walltime = job_walltime(job)
+        if walltime is None or not job['start']:
+            continue
+        for name in job['workers']:
+            releases.append((job['start'] + walltime, name, job['resources']))
+    return releases
+
+# Statuses after which a job no longer holds resources on the workers it was assigned to
+RELEASED_STATUSES = ('pending', 'completed', 'failed', 'killed', 'deleted')
+
+# Workers which recently failed to start jobs assigned to them
+_penalised = set()
+
+async def requeue_assignments(nc):
+    """
+    Return assigned jobs which were not started before their lease expired to pending,
+    recording the failures against their workers and notifying matchers of the jobs. Jobs
+    which have been requeued too many times are failed. The workers are told to delete
+    the jobs, since a slow worker may still try to start them. Returns the requeued jobs
+    """
+    results = await asyncio.to_thread(db.requeue_assignments, settings().matcher.max_requeues)
+    if not results:
+        return []
+
+    failures = {}
+    for result in results:
+        if result['worker']:
+            failures[result['worker']] = failures.get(result['worker'], 0) + 1
+    requeued = [result['job'] for result in results if result['job']['status'] == 'pending']
+    logger.info('Requeued %d and failed %d jobs which were not started by %d workers',
+                len(requeued), len(results) - len(requeued), len(failures))
+    if failures:
+        await asyncio.to_thread(db.record_failed_assignments, failures)
+
+    now = time.time()
+    try:
+        await publish(nc, [("worker.job.%s" % name, {'delete': result['job']})
+                           for result in results for name in result['workers'] if name] +
+                          [("matcher.job.%s" % job['id'], job) for job in requeued] +
+                          [status_change(result['job']['id'], result['job']['status'], now) for result in results])
+    except Exception as err:
+        logger.error('Got exception publishing status changes: %s', str(err))
+
+    return requeued
+
+async def match(nc, leases, idle_jobs, workers):
+    """
+    Match idle jobs to workers in order of priority, returning the ids of the jobs which are
+    no longer pending and the workers of each job which was assigned. The available
+    resources of the workers are reduced by the resources of the jobs which were assigned.
+    Workers which recently failed to start assigned jobs are only used if no other worker
+    can run a job. Nothing is assigned unless the leases on the partitions are still held
+    """
+    async def send(id, job):
+        data = json.dumps(job).encode('utf-8')
+        await nc.publish("worker.job.%s" % id, data)
+
+    # The index works on copies so that jobs which are matched but not assigned do not
+    # hold on to resources
+    index = TieredWorkerIndex()
+    for worker in workers:
+        index.add(worker['name'],
+                  dict(worker['resources']['available']),
+                  worker.get('images'),
+                  1 if worker['name'] in _penalised else 0)
+
+    releases = None
+    if settings().matcher.scheduler == 'backfill':
+        releases = await asyncio.to_thread(get_releases)
+
+    assignments = await asyncio.to_thread(schedule,
+                                          idle_jobs,
+                                          index,
+                                          settings().matcher.strategy,
+                                          settings().matcher.image_locality,
+                                          releases,
+                                          time.time(),
+                                          settings().matcher.reservations)
+    if not assignments:
+        return [], {}
+    jobs = {job['id']: job for job in idle_jobs if job['id'] in assignments}
+
+    # Another matcher may have taken over the partitions if the leases could not be renewed
+    if not leases.held():
+        logger.error('Leases on partitions may have expired, not assigning %d jobs', len(assignments))
+        return [], {}
+
+    assigned = set(await asyncio.to_thread(db.assign_jobs, assignments, settings().matcher.assignment_lease))
+    available = {worker['name']: worker['resources']['available'] for worker in workers}
+    assigned_time = time.time()
+    changes = []
+    pull_times = await asyncio.to_thread(get_pull_times)
+    warm = 0
+    saved = 0
+    for id, names in assignments.items():
+        if id in assigned:
+            logger.info('Job %s matched to workers %s', id, ', '.join(names))
+            for name in names:
+                if len(names) > 1:
+                    await send(name, {'create': jobs[id], 'nodes': names})
+                else:
+                    await send(name, {'create': jobs[id]})
+            for name in names:
+                for resource in ('cpus', 'memory', 'disk'):
+                    available[name][resource] -= jobs[id]['resources'][resource]
+            changes.append(status_change(id, 'assigned', assigned_time))
+            cached = [image for image in job_images(jobs[id]) if index.has_image(names[0], image)]
+            if cached:
+                warm += 1
+                saved += sum(pull_times.get(image, 0) for image in cached)
+        else:
+            logger.info('Job %s is no longer pending, not assigning it', id)
+
+    logger.info('Assigned %d jobs, %d to workers with cached images, saving an estimated %f secs pulling images',
+                len(assigned), warm, saved)
+
+    try:
+        await publish(nc, changes)
+    except Exception as err:
+        logger.error('Got exception publishing status changes: %s', str(err))
+
+    return list(assignments), {id: assignments[id] for id in assigned}
+
+async def expire_jobs(nc):
+    """
+    Fail pending jobs which have exceeded their maximum time in queue, returning their ids
+    """
+    expired = await asyncio.to_thread(db.expire_jobs)
+    if not expired:
+        return []
+
+    logger.info('Failed %d jobs which exceeded their maximum time in queue', len(expired))
+    now = time.time()
+    try:
+        await publish(nc, [status_change(id, 'failed', now) for id in expired])
+    except Exception as err:
+        logger.error('Got exception publishing status changes: %s', str(err))
+    return expired
+
+async def sweep(nc, leases):
+    """
+    Expire jobs which have exceeded their maximum time in queue and requeue jobs whose
+    assignment lease has expired, returning the ids of the expired jobs. This is only done
+    by the matcher owning partition 0, but every matcher reloads the penalised workers
+    """
+    global _penalised
+    expired = []
+    if 0 in leases.owned:
+        try:
+            expired = await expire_jobs(nc)
+        except Exception as err:
+            logger.error('Got exception expiring jobs: %s', str(err))
+
+        try:
+            await requeue_assignments(nc)
+        except Exception as err:
+            logger.error('Got exception requeuing assignments: %s', str(err))
+
+    try:
+        _penalised = await asyncio.to_thread(db.penalised_workers,
+                                             time.time() - settings().matcher.assignment_penalty)
+    except Exception as err:
+        logger.error('Got exception getting penalised workers: %s', str(err))
+    return expired
+
+async def matcher(nc, kv, leases):
+    """
+    Match idle jobs in the partitions owned to workers
+    """
+    if not leases.owned:
+        logger.info('No partitions owned, not matching')
+        return
+
+    logger.info('Starting matching...')
+    start_time = time.time()
+
+    await sweep(nc, leases)
+
+    logger.info('Getting idle jobs...')
+    idle_jobs = await asyncio.to_thread(get_idle_jobs, leases)
+    logger.info('There are %d idle jobs', len(idle_jobs))
+
+    logger.info('Getting workers...')
+    workers = await get_workers_timed(kv)
 
     logger.info('Matching...')
-    for job in idle_jobs:
-        for worker in workers:
-            if (workers_resources[worker['name']]['cpus'] >= job['resources']['cpus'] and
-                workers_resources[worker['name']]['memory'] >= job['resources']['memory'] and
-                workers_resources[worker['name']]['disk'] >= job['resources']['disk']):
-                logger.info('Job %s matched to worker %s', job['id'], worker['name'])
-                await send(worker['name'], {'create': job})
-                db.update_status(job['id'], 'assigned')
-                workers_resources[worker['name']]['cpus'] -= job['resources']['cpus']
-                workers_resources[worker['name']]['memory'] -= job['resources']['memory']
-                workers_resources[worker['name']]['disk'] -= job['resources']['disk']
-                break
+    await match(nc, leases, idle_jobs, workers)
 
     logger.info('Finished, took %f secs', time.time() - start_time)
-    await nc.close()
+
+async def acquire_leases(js):
+    """
+    Take a share of the partitions and keep renewing the leases on them
+    """
+    ttl = settings().matcher.lease_ttl
+    kv = await leases_bucket(js, settings().nats.leases_bucket, ttl)
+    leases = PartitionLeases(kv, settings().matcher.partitions, ttl)
+    await leases.renew()
+    asyncio.create_task(leases.renew_periodically())
+    return leases
+
+async def run_interval():
+    """
+    Match at the configured interval, using the same NATS connection throughout
+    """
+    nc = await connect()
+    js = nc.jetstream()
+    kv = await js.key_value(bucket=settings().nats.workers_bucket)
+    leases = await acquire_leases(js)
+    interval = settings().matcher.interval
+
+    try:
+        while True:
+            try:
+                await matcher(nc, kv, leases)
+            except Exception as err:
+                logger.error('Got exception matching: %s', str(err))
+            await asyncio.sleep(interval)
+    finally:
+        await leases.release()
+
+class EventMatcher(object):
+    """
+    Long-running matcher which keeps the pending jobs and workers in memory, updates them
+    from job creation notifications and the workers bucket and matches whenever either
+    changes. A periodic full resync is done as a safety net.
+
+    The resources of assigned jobs are deducted from the workers in memory. Workers are
+    only written to the bucket when what they report changes, so a job which starts and
+    ends between two heartbeats leaves no trace there. The deductions are therefore given
+    back when a job ends or is requeued, unless the worker has been updated since
+    """
+    def __init__(self, nc, kv, leases):
+        self._nc = nc
+        self._kv = kv
+        self._leases = leases
+        self._jobs = {}
+        self._workers = {}
+        self._held = {}
+        self._changed = asyncio.Event()
+
+    def _release(self, id):
+        """
+        Give back the resources deducted for a job to its workers, if they have not been
+        replaced by what they report since
+        """
+        for worker, resources in self._held.pop(id, []):
+            if self._workers.get(worker['name']) is not worker:
+                continue
+            for resource in ('cpus', 'memory', 'disk'):
+                worker['resources']['available'][resource] += resources[resource]
+            self._changed.set()
+
+    async def resync(self):
+        """
+        Reload all pending jobs and workers
+        """
+        logger.info('Resyncing pending jobs and workers...')
+        await sweep(self._nc, self._leases)
+
+        jobs = {}
+        if self._leases.owned:
+            for job in await asyncio.to_thread(get_idle_jobs, self._leases):
+                jobs[job['id']] = job
+        self._jobs = jobs
+
+        workers = {}
+        for worker in await get_workers_timed(self._kv):
+            workers[worker['name']] = worker
+        self._workers = workers
+        self._held = {}
+
+        logger.info('There are %d idle jobs and %d workers', len(self._jobs), len(self._workers))
+        self._changed.set()
+
+    async def resync_periodically(self):
+        """
+        Resync at the configured interval
+        """
+        interval = settings().matcher.resync_interval
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.resync()
+            except Exception as err:
+                logger.error('Got exception resyncing: %s', str(err))
+
+    async def sweep_periodically(self):
+        """
+        Fail jobs which have exceeded their maximum time in queue and requeue jobs whose
+        assignment lease has expired, at the configured interval
+        """
+        interval = settings().matcher.expiry_interval
+        while True:
+            await asyncio.sleep(interval)
+            for id in await sweep(self._nc, self._leases):
+                self._jobs.pop(id, None)
+
+    async def resync_on_lease_change(self):
+        """
+        Resync whenever partitions are acquired or released
+        """
+        while True:
+            await self._leases.changed.wait()
+            self._leases.changed.clear()
+            try:
+                await self.resync()
+            except Exception as err:
+                logger.error('Got exception resyncing: %s', str(err))
+
+    async def job_created(self, msg):
+        """
+        Add a newly created job to the pending queue
+        """
+        try:
+            job = json.loads(msg.data.decode())
+        except Exception as err:
+            logger.error('Got invalid job creation notification: %s', str(err))
+            return
+        if job.get('status') == 'pending' and self._leases.owns(job):
+            self._jobs[job['id']] = job
+            self._changed.set()
+
+    async def job_status_changed(self, msg):
+        """
+        Give back the resources of a job which has ended or been requeued
+        """
+        _, status, id = msg.subject.split('.', 2)
+        if status in RELEASED_STATUSES:
+            self._release(id)
+
+    async def watch_workers(self):
+        """
+        Keep the worker table up to date from the workers bucket
+        """
+        watcher = await self._kv.watchall()
+        while True:
+            try:
+                entry = await watcher.updates(timeout=60)
+            except nats.errors.TimeoutError:
+                continue
+            if entry is None:
+                continue
+
+            if entry.operation in ('DEL', 'PURGE'):
+                self._workers.pop(entry.key, None)
+                continue
+
+            try:
+                worker = json.loads(entry.value)
+            except Exception:
+                continue
+            if worker['status'] == 'ready':
+                self._workers[entry.key] = worker
+                self._changed.set()
+            else:
+                self._workers.pop(entry.key, None)
+
+    async def run(self):
+        """
+        Match whenever the pending jobs or workers change
+        """
+        self._leases.changed.clear()
+        await self.resync()
+        await self._nc.subscribe("matcher.job.*", cb=self.job_created)
+        await self._nc.subscribe("jobstatus.*.*", cb=self.job_status_changed)
+        asyncio.create_task(self.watch_workers())
+        asyncio.create_task(self.resync_periodically())
+        asyncio.create_task(self.sweep_periodically())
+        asyncio.create_task(self.resync_on_lease_change())
+
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            if not self._jobs or not self._workers:
+                continue
+
+            # Jobs stay in the table if matching fails, so they are retried on the next
+            # change or resync
+            start_time = time.time()
+            jobs = dict(self._jobs)
+            workers = dict(self._workers)
+            try:
+                done, assigned = await match(self._nc,
+                                             self._leases,
+                                             list(jobs.values()),
+                                             list(workers.values()))
+            except Exception as err:
+                logger.error('Got exception matching: %s', str(err))
+                continue
+            for id, names in assigned.items():
+                self._held[id] = [(workers[name], jobs[id]['resources']) for name in names]
+            for id in done:
+                self._jobs.pop(id, None)
+            if done:
+                logger.info('Matched %d jobs, took %f secs', len(done), time.time() - start_time)
+
+async def run_events():
+    """
+    Run the event-driven matcher
+    """
+    nc = await connect()
+    js = nc.jetstream()
+    kv = await js.key_value(bucket=settings().nats.workers_bucket)
+    leases = await acquire_leases(js)
+    try:
+        await EventMatcher(nc, kv, leases).run()
+    finally:
+        await leases.release()
 
 def main():
-    while True:
-        asyncio.run(matcher())
-        time.sleep(int(config().get('matcher', 'interval')))
+    reload_on_sighup()
+    db.ensure_indexes()
+
+    if settings().matcher.mode == 'events':
+        asyncio.run(run_events())
+    else:
+        asyncio.run(run_interval())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,9 @@
+"""Move flat job log files into the segmented log store"""
+from prominence.logs import log_store
+
+def main():
+    migrated = log_store().migrate_all()
+    print(f"Migrated {migrated} log files")
+
+if __name__ == '__main__':
+    main()
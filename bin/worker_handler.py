@@ -3,15 +3,91 @@ import asyncio
 import json
 import signal
 import sys
+import time
 
 import logging
 from logging.handlers import RotatingFileHandler
 
 import nats
 
-from prominence.utilities import config, set_logger
+from prominence.settings import reload_on_sighup, settings
+from prominence.utilities import set_logger
+
+logger = set_logger(settings().worker_handler.log)
+
+# Fields of a worker which, when changed, need to be written to the workers bucket. Workers
+# may advertise the images they have cached so that jobs can be placed where their images are
+TRACKED_FIELDS = ('status', 'resources', 'images')
+
+class WorkerTracker(object):
+    """
+    Keeps the workers bucket up to date, only writing workers when their status or
+    resources change, and evicting workers which have stopped sending heartbeats
+    """
+    def __init__(self, kv):
+        self._kv = kv
+        self._tracked = {}
+        self._last_seen = {}
+
+    async def load(self):
+        """
+        Start tracking the workers already in the bucket, which will be evicted if they do
+        not send a heartbeat
+        """
+        try:
+            names = await self._kv.keys()
+        except Exception:
+            names = []
+        now = time.monotonic()
+        for name in names:
+            self._last_seen[name] = now
+
+    async def update(self, data):
+        """
+        Handle a status message from a worker
+        """
+        name = data['name']
+        if data['status'] == 'leaving':
+            logger.info('Removing worker %s', name)
+            self._tracked.pop(name, None)
+            self._last_seen.pop(name, None)
+            await self._kv.delete(name)
+            return
+
+        self._last_seen[name] = time.monotonic()
+        tracked = {field: data.get(field) for field in TRACKED_FIELDS}
+        if self._tracked.get(name) == tracked:
+            return
 
-logger = set_logger(config().get('worker_handler', 'log'))
+        logger.info('Updating worker %s', name)
+        await self._kv.put(name, json.dumps(data).encode('utf-8'))
+        self._tracked[name] = tracked
+
+    async def evict(self, timeout):
+        """
+        Remove workers which have not been seen within the timeout
+        """
+        now = time.monotonic()
+        for name, last_seen in list(self._last_seen.items()):
+            if now - last_seen < timeout:
+                continue
+            logger.info('Evicting worker %s, last seen %d secs ago', name, now - last_seen)
+            try:
+                await self._kv.delete(name)
+            except Exception as err:
+                logger.error('Got exception evicting worker %s: %s', name, str(err))
+                continue
+            self._tracked.pop(name, None)
+            self._last_seen.pop(name, None)
+
+    async def evict_periodically(self):
+        """
+        Evict workers which have missed too many heartbeats
+        """
+        while True:
+            interval = settings().worker.heartbeat_interval
+            await asyncio.sleep(interval)
+            await self.evict(interval * settings().worker_handler.missed_heartbeats)
 
 async def run():
     async def error_cb(err):
@@ -28,7 +104,7 @@ async def run():
 
     nc = None
     try:
-        nc = await nats.connect(config().get('nats', 'url'),
+        nc = await nats.connect(settings().nats.url,
                                 max_reconnect_attempts=-1,
                                 disconnected_cb=disconnected_cb,
                                 reconnected_cb=reconnected_cb,
@@ -37,16 +113,16 @@ async def run():
     except Exception as err:
         logger.error('Got exception connecting to NATS: %s', str(err))
 
-    async def subscribe_handler(msg):
-        data = json.loads(msg.data.decode())
-        logger.info('Updating worker %s', data['name'])
+    js = nc.jetstream()
+    kv = await js.key_value(bucket=settings().nats.workers_bucket)
+    tracker = WorkerTracker(kv)
+    await tracker.load()
 
-        js = nc.jetstream()
-        kv = await js.key_value(bucket=config().get('nats', 'workers_bucket'))
-        if data['status'] == 'leaving':
-            await kv.delete(data['name'])
-        else:
-            await kv.put(data['name'], (json.dumps(data)).encode('utf-8'))
+    async def subscribe_handler(msg):
+        try:
+            await tracker.update(json.loads(msg.data.decode()))
+        except Exception as err:
+            logger.error('Got exception updating worker: %s', str(err))
 
     def signal_handler():
         if nc.is_closed:
@@ -58,7 +134,10 @@ async def run():
 
     await nc.subscribe("worker.status.*", cb=subscribe_handler)
 
+    asyncio.create_task(tracker.evict_periodically())
+
 def main():
+    reload_on_sighup()
     loop = asyncio.get_event_loop()
     loop.run_until_complete(run())
     try:
@@ -1,19 +1,53 @@
 import time
+import urllib.parse
+import httpx
 from pyArango.connection import Connection
+from pyArango.theExceptions import AQLQueryError
 
-from prominence.utilities import config
+from prominence.models import JobStatus
+from prominence.settings import settings
+
+# Persistent indexes on the jobs collection. Listings of jobs with a given status are
+# paginated in order of id using the index on status and id
+JOBS_INDEXES = [['status'], ['status', 'created'], ['group'], ['status', 'queueDeadline'],
+                ['status', 'assignmentDeadline'], ['status', '_key']]
+
+# Sparse persistent indexes on the workers collection, which only has documents for
+# workers with failed assignments
+WORKERS_INDEXES = [['lastFailedAssignment']]
+
+METRICS_QUERY = 'FOR job IN jobs COLLECT status = job.status WITH COUNT INTO count RETURN [status, count]'
+
+def status_counts(counts):
+    """
+    Return the number of jobs in every state, given counts for the states which have jobs
+    """
+    metrics = {status.value: 0 for status in JobStatus}
+    for status, count in counts:
+        metrics[status] = count
+    return metrics
 
 class Database(object):
     """
     Class for interacting with the database
     """
     def __init__(self):
-        self._conn = Connection(username=config().get('database', 'username'),
-                                password=config().get('database', 'password'))
-        self._db = self._conn[config().get('database', 'database')]
+        self._conn = Connection(arangoURL=settings().database.url,
+                                username=settings().database.username,
+                                password=settings().database.password)
+        self._db = self._conn[settings().database.database]
         self._jobs = self._db["jobs"]
         self._workers = self._db["workers"]
 
+    def ensure_indexes(self):
+        """
+        Create indexes if they do not already exist
+        """
+        for fields in JOBS_INDEXES:
+            self._jobs.ensurePersistentIndex(fields, sparse=False)
+        for fields in WORKERS_INDEXES:
+            self._workers.ensurePersistentIndex(fields, sparse=True)
+
     def create_job(self, job):
         """
         Create job
@@ -27,9 +61,11 @@ class Database(object):
         List jobs
         """
         filter = ''
+        bind_vars = {}
         if status:
-            filter = 'FILTER job.status == "%s"' % status
-        jobs = self._db.AQLQuery(f"FOR job IN jobs {filter} RETURN job", rawResults=True)
+            filter = 'FILTER job.status == @status'
+            bind_vars['status'] = status
+        jobs = self._db.AQLQuery(f"FOR job IN jobs {filter} RETURN job", rawResults=True, bindVars=bind_vars)
         jobs_list = []
         for job in jobs:
             jobs_list.append(job)
@@ -51,11 +87,20 @@ class Database(object):
         job['events'].append({'time': time.time(), 'type': 'deleting'})
         job.save()
 
-    def get_pending_jobs(self):
+    def get_pending_jobs(self, partitions=1, owned=None):
         """
-        Return pending jobs
+        Return pending jobs, optionally only those in the given partitions. Jobs stored
+        without a shard belong to partition 0
         """
-        jobs = self._db.AQLQuery('FOR job IN jobs FILTER job.status == "pending" RETURN job', rawResults=True)
+        if partitions > 1 and owned is not None and len(owned) < partitions:
+            query = """
+            FOR job IN jobs
+                FILTER job.status == "pending" AND NOT_NULL(job.shard, 0) % @partitions IN @owned
+                SORT job.created
+                RETURN job
+            """
+            return self._db.AQLQuery(query, rawResults=True, bindVars={'partitions': partitions, 'owned': owned})
+        jobs = self._db.AQLQuery('FOR job IN jobs FILTER job.status == "pending" SORT job.created RETURN job', rawResults=True)
         return jobs
 
     def update_status(self, id, status):
@@ -66,11 +111,422 @@ class Database(object):
         job['status'] = status
         job.save()
 
+    def update_job(self, id, status, events, execution=None, retry=False, worker=None, retries=3):
+        """
+        Atomically set the status of a job, append events and merge in execution details.
+        If retry is set and the job has retries remaining it is returned to pending instead,
+        with a new queue deadline. Events sent by a worker are only applied if the job is
+        still assigned to, running on or being deleted from that worker, so a worker whose
+        assignment was requeued cannot change the job. Returns the job, updated if the
+        events were applied, and whether they were, or None if the job does not exist
+        """
+        query = """
+        LET job = DOCUMENT("jobs", @id)
+        FILTER job != null
+        LET applied = @worker == null OR
+                      (job.status IN ["assigned", "running", "deleting"] AND
+                       @worker IN (job.execution.workers ? job.execution.workers : [job.execution.worker]))
+        LET retry = @retry AND job.policies.maximumRetries > 0 AND
+                    NOT_NULL(job.execution.retries, 0) < job.policies.maximumRetries
+        LET updated = (
+            FOR current IN (applied ? [job] : [])
+                UPDATE current WITH MERGE({
+                    status: retry ? "pending" : @status,
+                    events: APPEND(NOT_NULL(job.events, []),
+                                   retry ? APPEND(@events, [{time: @time, type: "retrying"}]) : @events),
+                    execution: MERGE(NOT_NULL(job.execution, {}),
+                                     @execution,
+                                     retry ? {retries: NOT_NULL(job.execution.retries, 0) + 1} : {})
+                }, retry && job.queueDeadline ? {queueDeadline: @time + job.policies.maximumTimeInQueue*60} : {})
+                IN jobs OPTIONS {ignoreRevs: false, mergeObjects: false}
+                RETURN NEW
+        )
+        RETURN {job: applied ? FIRST(updated) : job, applied: applied}
+        """
+        bind_vars = {'id': id,
+                     'status': status,
+                     'events': events,
+                     'execution': execution or {},
+                     'retry': retry,
+                     'worker': worker,
+                     'time': time.time()}
+        for attempt in range(retries):
+            try:
+                results = list(self._db.AQLQuery(query, rawResults=True, bindVars=bind_vars))
+                break
+            except AQLQueryError:
+                # The job was changed since it was read, so the query was rolled back and
+                # can safely be retried
+                if attempt == retries - 1:
+                    raise
+        if results:
+            return results[0]['job'], results[0]['applied']
+        return None, False
+
+    def assign_jobs(self, assignments, lease, batch_size=1000, retries=3):
+        """
+        Move jobs from pending to assigned, given a dict of job ids to the names of the
+        workers running each of their nodes, the first of which is the job's worker. Only jobs
+        which are still pending and have not exceeded their maximum time in queue are changed,
+        and their ids are returned. This is a compare-and-set on the status, so a job is
+        never assigned twice even if several matchers try to assign it at once. Workers must
+        start the jobs before the lease (in seconds) expires, otherwise they are requeued.
+        The workers of any earlier assignment are replaced rather than merged
+        """
+        query = """
+        FOR job IN jobs
+            FILTER job._key IN @ids AND job.status == "pending"
+            FILTER NOT job.queueDeadline OR job.queueDeadline > @time
+            UPDATE job WITH {
+                status: "assigned",
+                assignmentDeadline: @time + @lease,
+                execution: MERGE(UNSET(NOT_NULL(job.execution, {}), "worker", "workers"),
+                                 {worker: FIRST(@workers[job._key])},
+                                 LENGTH(@workers[job._key]) > 1 ? {workers: @workers[job._key]} : {}),
+                events: PUSH(job.events, {time: @time, type: "assigned"})
+            } IN jobs OPTIONS {ignoreRevs: false, mergeObjects: false}
+            RETURN NEW._key
+        """
+        ids = list(assignments)
+        assigned = []
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            bind_vars = {'ids': batch,
+                         'workers': {id: assignments[id] for id in batch},
+                         'time': time.time(),
+                         'lease': lease}
+            for attempt in range(retries):
+                try:
+                    jobs = self._db.AQLQuery(query, rawResults=True, bindVars=bind_vars, batchSize=batch_size)
+                    assigned.extend(jobs)
+                    break
+                except AQLQueryError:
+                    # Another write to one of the jobs conflicted, so the query was rolled
+                    # back and can safely be retried
+                    if attempt == retries - 1:
+                        raise
+        return assigned
+
+    def expire_jobs(self, batch_size=1000, retries=3):
+        """
+        Fail pending jobs which have been in the queue for longer than allowed by their
+        policies, returning their ids. Overdue jobs are found using the queue deadline index
+        """
+        query = """
+        FOR job IN jobs
+            FILTER job.status == "pending" AND job.queueDeadline > 0 AND job.queueDeadline <= @time
+            LIMIT @limit
+            UPDATE job WITH {
+                status: "failed",
+                events: PUSH(job.events, {time: @time, type: "timedout"})
+            } IN jobs OPTIONS {ignoreRevs: false}
+            RETURN NEW._key
+        """
+        return self._update_in_batches(query, batch_size, retries)
+
+    def requeue_assignments(self, max_requeues, batch_size=1000, retries=3):
+        """
+        Return assigned jobs which were not started before their assignment lease expired
+        to pending, returning the updated jobs, the worker they had been assigned to and
+        the workers running each of their nodes. Jobs which have already been requeued the
+        maximum number of times are failed instead. Expired leases are found using the
+        assignment deadline index. Once a job has started its deadline no longer applies
+        """
+        query = """
+        FOR job IN jobs
+            FILTER job.status == "assigned" AND job.assignmentDeadline > 0 AND job.assignmentDeadline <= @time
+            LIMIT @limit
+            LET requeue = NOT_NULL(job.execution.requeues, 0) < @max_requeues
+            UPDATE job WITH MERGE({
+                status: requeue ? "pending" : "failed",
+                events: PUSH(job.events, {time: @time, type: requeue ? "requeued" : "notstarted"}),
+                execution: requeue ? {retries: NOT_NULL(job.execution.retries, 0) + 1,
+                                      requeues: NOT_NULL(job.execution.requeues, 0) + 1} : {}
+            }, requeue && job.queueDeadline ? {queueDeadline: @time + job.policies.maximumTimeInQueue*60} : {})
+            IN jobs OPTIONS {ignoreRevs: false}
+            RETURN {job: NEW,
+                    worker: OLD.execution.worker,
+                    workers: OLD.execution.workers ? OLD.execution.workers : [OLD.execution.worker]}
+        """
+        return self._update_in_batches(query, batch_size, retries, {'max_requeues': max_requeues})
+
+    def get_active_jobs(self):
+        """
+        Return the resources, workers and start time of assigned and running jobs. Jobs
+        which have not yet started are treated as starting when they were assigned
+        """
+        query = """
+        FOR job IN jobs
+            FILTER job.status IN ["assigned", "running"]
+            RETURN {
+                resources: job.resources,
+                workers: job.execution.workers ? job.execution.workers : [job.execution.worker],
+                start: LAST(job.events[* FILTER CURRENT.type IN ["assigned", "started"]]).time
+            }
+        """
+        return self._db.AQLQuery(query, rawResults=True, batchSize=1000)
+
+    def _update_in_batches(self, query, batch_size, retries, bind_vars=None):
+        """
+        Run an update query with @time and @limit bind variables, and any others given,
+        until it changes fewer than a full batch of jobs, returning all results
+        """
+        results = []
+        while True:
+            bind_vars = dict(bind_vars or {}, time=time.time(), limit=batch_size)
+            for attempt in range(retries):
+                try:
+                    batch = list(self._db.AQLQuery(query, rawResults=True, bindVars=bind_vars, batchSize=batch_size))
+                    break
+                except AQLQueryError:
+                    # Another write to one of the jobs conflicted, so the query was rolled
+                    # back and can safely be retried
+                    if attempt == retries - 1:
+                        raise
+            results.extend(batch)
+            if len(batch) < batch_size:
+                return results
+
+    def record_failed_assignments(self, failures):
+        """
+        Add to the tally of failed assignments of each worker, given a dict of worker names
+        to the number of jobs they failed to start
+        """
+        query = """
+        FOR failure IN @failures
+            UPSERT {_key: failure.worker}
+            INSERT {_key: failure.worker, failedAssignments: failure.count, lastFailedAssignment: @time}
+            UPDATE {failedAssignments: NOT_NULL(OLD.failedAssignments, 0) + failure.count,
+                    lastFailedAssignment: @time}
+            IN workers
+        """
+        bind_vars = {'failures': [{'worker': worker, 'count': count} for worker, count in failures.items()],
+                     'time': time.time()}
+        self._db.AQLQuery(query, rawResults=True, bindVars=bind_vars)
+
+    def penalised_workers(self, since):
+        """
+        Return the names of workers which have failed to start an assigned job since the
+        given time
+        """
+        query = 'FOR worker IN workers FILTER worker.lastFailedAssignment >= @since RETURN worker._key'
+        return set(self._db.AQLQuery(query, rawResults=True, bindVars={'since': since}, batchSize=1000))
+
+    def image_pull_times(self, limit=10000):
+        """
+        Return the average time taken to pull each image, from the most recently completed
+        jobs which had to pull their images
+        """
+        query = """
+        FOR job IN jobs
+            FILTER job.status == "completed"
+            SORT job.status DESC, job.created DESC
+            LIMIT @limit
+            FILTER LENGTH(job.execution.tasks) > 0
+            FOR position IN 0..LENGTH(job.execution.tasks) - 1
+                LET task = job.execution.tasks[position]
+                FILTER task.imagePullStatus == "completed" AND task.imagePullTime != null
+                COLLECT image = job.tasks[position].image AGGREGATE time = AVG(task.imagePullTime)
+                RETURN {image, time}
+        """
+        results = self._db.AQLQuery(query, rawResults=True, bindVars={'limit': limit}, batchSize=1000)
+        return {result['image']: result['time'] for result in results}
+
     def metrics(self):
         """
-        Job metrics
+        Job metrics, the number of jobs in each state
+        """
+        return status_counts(self._db.AQLQuery(METRICS_QUERY, rawResults=True))
+
+class AsyncDatabase(object):
+    """
+    Class for interacting with the database without blocking the event loop, using a
+    pool of HTTP connections to ArangoDB
+    """
+    def __init__(self):
+        database = settings().database
+        self._client = httpx.AsyncClient(
+            base_url=f"{database.url}/_db/{database.database}",
+            auth=(database.username, database.password),
+            limits=httpx.Limits(max_connections=database.pool_size,
+                                max_keepalive_connections=database.pool_size),
+            timeout=database.timeout
+        )
+
+    async def close(self):
+        """
+        Close all connections
+        """
+        await self._client.aclose()
+
+    async def ensure_indexes(self):
+        """
+        Create indexes if they do not already exist
+        """
+        for fields in JOBS_INDEXES:
+            response = await self._client.post('/_api/index', params={'collection': 'jobs'},
+                                               json={'type': 'persistent', 'fields': fields})
+            response.raise_for_status()
+
+    async def query(self, query, bind_vars=None, batch_size=1000):
+        """
+        Run an AQL query, yielding results as each batch arrives from the cursor
+        """
+        response = await self._client.post('/_api/cursor', json={'query': query,
+                                                                 'bindVars': bind_vars or {},
+                                                                 'batchSize': batch_size})
+        response.raise_for_status()
+        data = response.json()
+        try:
+            for result in data['result']:
+                yield result
+            while data['hasMore']:
+                response = await self._client.put(f"/_api/cursor/{data['id']}")
+                response.raise_for_status()
+                data = response.json()
+                for result in data['result']:
+                    yield result
+        finally:
+            if data.get('hasMore'):
+                await self._client.delete(f"/_api/cursor/{data['id']}")
+
+    async def query_all(self, query, bind_vars=None, batch_size=1000):
+        """
+        Run an AQL query, returning all results
         """
-        running_jobs = self._db.AQLQuery('FOR job IN jobs FILTER job.status == "running" COLLECT WITH COUNT INTO length RETURN length', rawResults=True)[0]
-        pending_jobs = self._db.AQLQuery('FOR job IN jobs FILTER job.status == "pending" COLLECT WITH COUNT INTO length RETURN length', rawResults=True)[0]
+        return [result async for result in self.query(query, bind_vars, batch_size)]
 
-        return running_jobs, pending_jobs
+    async def create_job(self, job):
+        """
+        Create job
+        """
+        response = await self._client.post('/_api/document/jobs', json=dict(job, _key=job['id']))
+        response.raise_for_status()
+
+    def _list_jobs_query(self, status=None, after=None, limit=None, fields=None, group=None):
+        """
+        Return the query and bind variables for listing jobs in order of id, starting after
+        the given id, optionally returning only some fields
+        """
+        filters = []
+        bind_vars = {}
+        if status:
+            filters.append('FILTER job.status == @status')
+            bind_vars['status'] = status
+        if group:
+            filters.append('FILTER job.group == @group')
+            bind_vars['group'] = group
+        if after:
+            filters.append('FILTER job._key > @after')
+            bind_vars['after'] = after
+
+        limit_clause = ''
+        if limit:
+            limit_clause = 'LIMIT @limit'
+            bind_vars['limit'] = limit
+
+        if fields:
+            result = 'KEEP(job, @fields)'
+            bind_vars['fields'] = list(set(fields) | {'id'})
+        else:
+            result = 'UNSET(job, "_key", "_id", "_rev")'
+
+        query = f"FOR job IN jobs {' '.join(filters)} SORT job._key {limit_clause} RETURN {result}"
+        return query, bind_vars
+
+    async def create_jobs(self, jobs, batch_size=1000):
+        """
+        Create many jobs using bulk imports. Each import is atomic but the batches are not,
+        so if any batch fails the jobs already created are removed again before raising
+        """
+        end = 0
+        try:
+            for start in range(0, len(jobs), batch_size):
+                end = start + batch_size
+                response = await self._client.post('/_api/import',
+                                                   params={'collection': 'jobs', 'type': 'list', 'complete': 'true'},
+                                                   json=[dict(job, _key=job['id']) for job in jobs[start:end]])
+                response.raise_for_status()
+        except Exception:
+            # The failed batch is included as it may have been imported even if the
+            # response was lost
+            await self.query_all("""
+                FOR id IN @ids
+                    REMOVE id IN jobs OPTIONS {ignoreErrors: true}
+            """, {'ids': [job['id'] for job in jobs[:end]]})
+            raise
+
+    async def list_jobs(self, status=None, after=None, limit=None, fields=None, group=None):
+        """
+        List jobs
+        """
+        return await self.query_all(*self._list_jobs_query(status, after, limit, fields, group))
+
+    async def stream_jobs(self, status=None, after=None, limit=None, fields=None, group=None):
+        """
+        List jobs, yielding them as they arrive from the database
+        """
+        async for job in self.query(*self._list_jobs_query(status, after, limit, fields, group)):
+            yield job
+
+    async def get_job(self, id):
+        """
+        Describe job
+        """
+        response = await self._client.get(f"/_api/document/jobs/{urllib.parse.quote(id, safe='')}")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    async def delete_job(self, id):
+        """
+        Delete job, returning the updated job
+        """
+        jobs = await self.query_all("""
+            FOR job IN jobs
+                FILTER job._key == @id
+                UPDATE job WITH {
+                    status: "deleting",
+                    events: PUSH(job.events, {time: @time, type: "deleting"})
+                } IN jobs
+                RETURN NEW
+        """, {'id': id, 'time': time.time()})
+        if jobs:
+            return jobs[0]
+        return None
+
+    async def delete_jobs(self, ids=None, status=None, group=None, limit=1000):
+        """
+        Delete up to the given number of jobs with the given ids, status or group, returning
+        the updated jobs
+        """
+        filters = []
+        bind_vars = {'time': time.time(), 'limit': limit}
+        if ids:
+            filters.append('FILTER job._key IN @ids')
+            bind_vars['ids'] = ids
+        if status:
+            filters.append('FILTER job.status == @status')
+            bind_vars['status'] = status
+        if group:
+            filters.append('FILTER job.group == @group')
+            bind_vars['group'] = group
+
+        return await self.query_all(f"""
+            FOR job IN jobs
+                {' '.join(filters)}
+                FILTER job.status NOT IN ["deleting", "deleted"]
+                LIMIT @limit
+                UPDATE job WITH {{
+                    status: "deleting",
+                    events: PUSH(job.events, {{time: @time, type: "deleting"}})
+                }} IN jobs
+                RETURN NEW
+        """, bind_vars)
+
+    async def metrics(self):
+        """
+        Job metrics, the number of jobs in each state
+        """
+        return status_counts(await self.query_all(METRICS_QUERY))
@@ -0,0 +1,26 @@
+"""Dependencies shared by the API routers"""
+from fastapi import Request
+
+def get_db(request: Request):
+    """
+    Return the database
+    """
+    return request.app.state.db
+
+def get_log_relay(request: Request):
+    """
+    Return the relay of live job output
+    """
+    return request.app.state.log_relay
+
+def get_messaging(request: Request):
+    """
+    Return the connection to NATS
+    """
+    return request.app.state.messaging
+
+def get_status_watcher(request: Request):
+    """
+    Return the watcher of job status changes
+    """
+    return request.app.state.status_watcher
@@ -0,0 +1,105 @@
+"""Relaying live job output and status changes from NATS to API clients"""
+import asyncio
+from contextlib import asynccontextmanager
+
+from prominence.logs import OFFSET_HEADER, relay_subject
+
+class LogRelay(object):
+    """
+    Relays job output to any number of watchers once the job logger has written it, tagged
+    with its offset in the log. There is one subscription per job and stream, shared by
+    all of its watchers
+    """
+    def __init__(self, messaging, max_queued=1000):
+        self._messaging = messaging
+        self._max_queued = max_queued
+        self._lock = asyncio.Lock()
+        self._watchers = {}
+        self._subs = {}
+
+    def _publish(self, key, item):
+        for queue in list(self._watchers.get(key, ())):
+            try:
+                queue.put_nowait(item)
+            except asyncio.QueueFull:
+                # The watcher is not keeping up, so end it rather than buffer without limit
+                self._watchers[key].discard(queue)
+                queue.get_nowait()
+                queue.put_nowait(('end', None, None))
+
+    async def _subscribe(self, key):
+        id, stream = key
+
+        async def output_handler(msg):
+            try:
+                offset = int((msg.headers or {})[OFFSET_HEADER])
+            except (KeyError, ValueError):
+                return
+            if msg.data:
+                self._publish(key, ('data', offset, msg.data))
+            else:
+                self._publish(key, ('end', offset, None))
+
+        nc = self._messaging.nc
+        self._subs[key] = await nc.subscribe(relay_subject(id, stream), cb=output_handler)
+
+    @asynccontextmanager
+    async def watch(self, id, stream):
+        """
+        Watch the output of a job, yielding a queue which receives ('data', offset, bytes)
+        items followed by ('end', size, None) once the job has finished. The size is None
+        if the watcher fell too far behind
+        """
+        key = (id, stream)
+        queue = asyncio.Queue(maxsize=self._max_queued)
+        async with self._lock:
+            if key not in self._subs:
+                await self._subscribe(key)
+            self._watchers.setdefault(key, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            async with self._lock:
+                self._watchers[key].discard(queue)
+                if not self._watchers[key]:
+                    del self._watchers[key]
+                    await self._subs.pop(key).unsubscribe()
+
+class StatusWatcher(object):
+    """
+    Notifies waiters of changes to the status of a job, as recorded in the stream of job
+    status changes. There is a single subscription to the status changes of all jobs,
+    which is only open while there are waiters
+    """
+    def __init__(self, messaging):
+        self._messaging = messaging
+        self._lock = asyncio.Lock()
+        self._waiters = {}
+        self._sub = None
+
+    async def _status_handler(self, msg):
+        _, status, id = msg.subject.split('.', 2)
+        for queue in self._waiters.get(id, ()):
+            queue.put_nowait(status)
+
+    @asynccontextmanager
+    async def watch(self, id):
+        """
+        Watch the status of a job, yielding a queue which receives each new status once it
+        has been written to the database
+        """
+        queue = asyncio.Queue()
+        async with self._lock:
+            if self._sub is None:
+                self._sub = await self._messaging.nc.subscribe("jobstatus.*.*", cb=self._status_handler)
+            self._waiters.setdefault(id, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            async with self._lock:
+                self._waiters[id].discard(queue)
+                if not self._waiters[id]:
+                    del self._waiters[id]
+                if not self._waiters and self._sub is not None:
+                    await self._sub.unsubscribe()
+                    self._sub = None
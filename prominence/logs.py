@@ -0,0 +1,79 @@
+"""Reading job standard output and error"""
+import asyncio
+import re
+
+from prominence.logstore import LogStore
+from prominence.settings import settings
+
+# Header giving the offset in the log of output relayed once it has been written
+OFFSET_HEADER = 'Log-Offset'
+
+class InvalidRange(Exception):
+    """
+    Requested range cannot be satisfied
+    """
+    pass
+
+def log_store():
+    """
+    Return the store containing job logs
+    """
+    job_logger = settings().job_logger
+    return LogStore(job_logger.directory,
+                    job_logger.segment_size,
+                    job_logger.max_size,
+                    job_logger.compression_level)
+
+def relay_subject(id, stream):
+    """
+    Return the subject on which output is relayed once it has been written to the log. An
+    empty message marks the end of the output
+    """
+    return f"joblogs.{id}.{stream}"
+
+def log_size(id, stream):
+    """
+    Return the size of a log, or 0 if it does not exist
+    """
+    return log_store().size(id, stream)
+
+def parse_range(header, size):
+    """
+    Return the start and end (exclusive) offsets from a single HTTP Range header
+    """
+    match = re.fullmatch(r'\s*bytes=(\d*)-(\d*)\s*', header)
+    if not match or (not match.group(1) and not match.group(2)):
+        raise InvalidRange(header)
+
+    if not match.group(1):
+        start = max(size - int(match.group(2)), 0)
+        end = size
+    else:
+        start = int(match.group(1))
+        end = size
+        if match.group(2):
+            end = min(int(match.group(2)) + 1, size)
+
+    if start >= size or start >= end:
+        raise InvalidRange(header)
+    return start, end
+
+def tail_offset(id, stream, lines):
+    """
+    Return the offset of the start of the last lines of a log
+    """
+    return log_store().tail_offset(id, stream, lines)
+
+async def read_range(id, stream, start, end):
+    """
+    Read part of a log in chunks without blocking the event loop
+    """
+    chunks = log_store().read(id, stream, start, end)
+    try:
+        while True:
+            data = await asyncio.to_thread(next, chunks, None)
+            if data is None:
+                break
+            yield data
+    finally:
+        await asyncio.to_thread(chunks.close)
@@ -0,0 +1,271 @@
+"""Storage of job standard output and error as compressed segments"""
+import hashlib
+import json
+import os
+import re
+import zlib
+
+CHUNK_SIZE = 65536
+
+def _segment_name(offset, compressed):
+    if compressed:
+        return f"{offset:016d}.z"
+    return f"{offset:016d}.log"
+
+def _read_index(path):
+    """
+    Return the index of a log, listing the offset, length and file of each sealed segment
+    """
+    try:
+        with open(os.path.join(path, 'index.json')) as fd:
+            return json.load(fd)
+    except FileNotFoundError:
+        return {'segments': [], 'size': 0, 'truncated': False}
+
+def _write_index(path, index):
+    """
+    Atomically replace the index of a log
+    """
+    filename = os.path.join(path, 'index.json')
+    with open(f"{filename}.tmp", 'w') as fd:
+        json.dump(index, fd)
+    os.replace(f"{filename}.tmp", filename)
+
+class LogFile(object):
+    """
+    A log being written. Data is appended to an uncompressed active segment which is
+    compressed once it reaches the segment size
+    """
+    def __init__(self, path, segment_size, max_size, level):
+        self._path = path
+        self._segment_size = segment_size
+        self._max_size = max_size
+        self._level = level
+        os.makedirs(path, exist_ok=True)
+        self._index = _read_index(path)
+        self._open_active()
+
+    def _open_active(self):
+        self._offset = self._index['size']
+        self._fh = open(os.path.join(self._path, _segment_name(self._offset, False)), 'ab')
+        self._active_size = self._fh.tell()
+
+    @property
+    def size(self):
+        """
+        Total uncompressed size of the log
+        """
+        return self._offset + self._active_size
+
+    def write(self, data):
+        """
+        Append data, discarding anything beyond the maximum size of the log
+        """
+        remaining = self._max_size - self.size
+        if len(data) > remaining:
+            data = data[:max(remaining, 0)]
+            if not self._index['truncated']:
+                self._index['truncated'] = True
+                _write_index(self._path, self._index)
+
+        while data:
+            chunk = data[:self._segment_size - self._active_size]
+            data = data[len(chunk):]
+            self._fh.write(chunk)
+            self._active_size += len(chunk)
+            if self._active_size >= self._segment_size:
+                self._seal()
+
+    def _seal(self):
+        """
+        Compress the active segment and start a new one
+        """
+        self._fh.close()
+        active = os.path.join(self._path, _segment_name(self._offset, False))
+        with open(active, 'rb') as fd:
+            data = zlib.compress(fd.read(), self._level)
+
+        name = _segment_name(self._offset, True)
+        with open(os.path.join(self._path, f"{name}.tmp"), 'wb') as fd:
+            fd.write(data)
+        os.replace(os.path.join(self._path, f"{name}.tmp"), os.path.join(self._path, name))
+
+        self._index['segments'].append([self._offset, self._active_size, name])
+        self._index['size'] = self._offset + self._active_size
+        _write_index(self._path, self._index)
+
+        # Readers which loaded the previous index may still have the old active segment
+        # open, which remains readable after it is removed
+        self._open_active()
+        os.remove(active)
+
+    def flush(self):
+        """
+        Flush the active segment
+        """
+        self._fh.flush()
+
+    def close(self):
+        """
+        Close the log
+        """
+        self._fh.close()
+
+class LogStore(object):
+    """
+    Per-job logs stored as fixed-size compressed segments in a sharded directory layout,
+    with an index mapping uncompressed offsets to segments so that ranges and tails can be
+    read without decompressing the whole log
+    """
+    def __init__(self, directory, segment_size=1048576, max_size=1073741824, level=6):
+        self._directory = directory
+        self._segment_size = segment_size
+        self._max_size = max_size
+        self._level = level
+
+    def path(self, id, stream):
+        """
+        Return the directory containing a log
+        """
+        digest = hashlib.md5(id.encode()).hexdigest()
+        return os.path.join(self._directory, digest[0:2], digest[2:4], id, stream)
+
+    def open(self, id, stream):
+        """
+        Open a log for writing
+        """
+        return LogFile(self.path(id, stream), self._segment_size, self._max_size, self._level)
+
+    def _snapshot(self, path):
+        """
+        Return the index of a log together with its open active segment and its size
+        """
+        for _ in range(3):
+            index = _read_index(path)
+            try:
+                fd = open(os.path.join(path, _segment_name(index['size'], False)), 'rb')
+            except FileNotFoundError:
+                # The active segment was sealed after the index was read, or nothing has
+                # been written yet
+                if os.path.exists(os.path.join(path, 'index.json')) or index['segments']:
+                    continue
+                return index, None, 0
+            return index, fd, os.fstat(fd.fileno()).st_size
+        return index, None, 0
+
+    def size(self, id, stream):
+        """
+        Return the uncompressed size of a log
+        """
+        index, fd, active_size = self._snapshot(self.path(id, stream))
+        if fd:
+            fd.close()
+        return index['size'] + active_size
+
+    def truncated(self, id, stream):
+        """
+        Return True if data was discarded because the log reached its maximum size
+        """
+        return _read_index(self.path(id, stream))['truncated']
+
+    def _segments(self, path, index, fd, active_size):
+        """
+        Generate the offset, length and a function reading each segment
+        """
+        for offset, length, name in index['segments']:
+            def read(name=name):
+                with open(os.path.join(path, name), 'rb') as segment:
+                    return zlib.decompress(segment.read())
+            yield offset, length, read
+        if fd:
+            def read_active():
+                fd.seek(0)
+                return fd.read(active_size)
+            yield index['size'], active_size, read_active
+
+    def read(self, id, stream, start, end):
+        """
+        Generate the data between the given uncompressed offsets, decompressing only the
+        segments which overlap the range
+        """
+        path = self.path(id, stream)
+        index, fd, active_size = self._snapshot(path)
+        try:
+            for offset, length, read in self._segments(path, index, fd, active_size):
+                if offset + length <= start:
+                    continue
+                if offset >= end:
+                    break
+                data = read()[max(start - offset, 0):end - offset]
+                for position in range(0, len(data), CHUNK_SIZE):
+                    yield data[position:position + CHUNK_SIZE]
+        finally:
+            if fd:
+                fd.close()
+
+    def tail_offset(self, id, stream, lines):
+        """
+        Return the offset of the start of the last lines of a log, reading segments
+        backwards from the end
+        """
+        path = self.path(id, stream)
+        index, fd, active_size = self._snapshot(path)
+        size = index['size'] + active_size
+        if not size or lines < 1:
+            if fd:
+                fd.close()
+            return size
+
+        try:
+            newlines = 0
+            last = True
+            for offset, _, read in reversed(list(self._segments(path, index, fd, active_size))):
+                data = read()
+                if not data:
+                    continue
+                position = len(data)
+                # A trailing newline ends the last line rather than starting a new one
+                if last and data.endswith(b'\n'):
+                    position -= 1
+                last = False
+                while True:
+                    position = data.rfind(b'\n', 0, position)
+                    if position < 0:
+                        break
+                    newlines += 1
+                    if newlines == lines:
+                        return offset + position + 1
+            return 0
+        finally:
+            if fd:
+                fd.close()
+
+    def migrate(self, filename, id, stream):
+        """
+        Move a flat, uncompressed log file into the store
+        """
+        log = self.open(id, stream)
+        try:
+            with open(filename, 'rb') as fd:
+                while True:
+                    data = fd.read(self._segment_size)
+                    if not data:
+                        break
+                    log.write(data)
+        finally:
+            log.close()
+        os.remove(filename)
+
+    def migrate_all(self):
+        """
+        Move all flat log files in the top-level directory into the store, returning the
+        number of files migrated
+        """
+        migrated = 0
+        for name in os.listdir(self._directory):
+            match = re.fullmatch(r'jobs\.(.+)\.(stdout|stderr)', name)
+            filename = os.path.join(self._directory, name)
+            if match and os.path.isfile(filename):
+                self.migrate(filename, match.group(1), match.group(2))
+                migrated += 1
+        return migrated
@@ -1,18 +1,45 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from .routers import jobs
+from .database import AsyncDatabase
+from .follow import LogRelay, StatusWatcher
+from .messaging import Messaging
+from .settings import reload_on_sighup, settings
+
+# Fail at startup rather than mid-request if the configuration is invalid
+settings()
+from .routers import jobs, metrics
 
 metadata = [
     {
         "name": "jobs",
         "description": "Operations with jobs"
+    },
+    {
+        "name": "metrics",
+        "description": "Job metrics"
     }
 ]
 
+@asynccontextmanager
+async def lifespan(app):
+    reload_on_sighup()
+    app.state.db = AsyncDatabase()
+    await app.state.db.ensure_indexes()
+    app.state.messaging = Messaging()
+    await app.state.messaging.connect()
+    app.state.log_relay = LogRelay(app.state.messaging)
+    app.state.status_watcher = StatusWatcher(app.state.messaging)
+    yield
+    await app.state.messaging.close()
+    await app.state.db.close()
+
 app = FastAPI(
     title='PROMINENCE',
     description='Run containerised jobs across many clouds',
     version='0.0.0',
-    openapi_tags=metadata
+    openapi_tags=metadata,
+    lifespan=lifespan
 )
 
 app.include_router(jobs.router)
+app.include_router(metrics.router)
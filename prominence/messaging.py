@@ -0,0 +1,89 @@
+"""NATS connection shared by the API, and the stream of job status changes"""
+import json
+import logging
+
+import nats
+from nats.js.api import StreamConfig
+from nats.js.errors import BadRequestError
+
+from prominence.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Stream recording every change of job status, on subjects jobstatus.<status>.<id>
+STATUS_STREAM = 'JOB_STATUS'
+
+def status_change(id, status, time):
+    """
+    Return the subject and record published when the status of a job changes
+    """
+    return f"jobstatus.{status}.{id}", {'id': id, 'status': status, 'time': time}
+
+async def publish(nc, messages):
+    """
+    Publish a list of (subject, data) messages, flushing once all have been sent
+    """
+    for subject, data in messages:
+        await nc.publish(subject, json.dumps(data).encode('utf-8'))
+    await nc.flush()
+
+async def ensure_status_stream(nc):
+    """
+    Create or update the stream of job status changes
+    """
+    js = nc.jetstream()
+    config = StreamConfig(name=STATUS_STREAM,
+                          subjects=['jobstatus.>'],
+                          max_age=settings().nats.status_max_age)
+    try:
+        await js.add_stream(config)
+    except BadRequestError:
+        # The stream already exists with a different configuration
+        await js.update_stream(config)
+
+class Messaging(object):
+    """
+    Connection to NATS shared by all requests for the lifetime of the API
+    """
+    def __init__(self):
+        self.nc = None
+
+    async def connect(self):
+        """
+        Connect to NATS, reconnecting indefinitely if the connection is lost
+        """
+        async def error_cb(err):
+            logger.error(err)
+
+        async def disconnected_cb():
+            logger.error('Got disconnected from NATS')
+
+        async def reconnected_cb():
+            logger.error('Got reconnected to NATS')
+
+        async def closed_cb():
+            logger.error('Stopped reconnection to NATS')
+
+        self.nc = await nats.connect(settings().nats.url,
+                                     max_reconnect_attempts=-1,
+                                     disconnected_cb=disconnected_cb,
+                                     reconnected_cb=reconnected_cb,
+                                     closed_cb=closed_cb,
+                                     error_cb=error_cb)
+        try:
+            await ensure_status_stream(self.nc)
+        except Exception as err:
+            logger.error('Got exception creating status stream: %s', str(err))
+
+    async def close(self):
+        """
+        Flush pending messages and close the connection
+        """
+        if self.nc and not self.nc.is_closed:
+            await self.nc.drain()
+
+    async def publish(self, messages):
+        """
+        Publish a list of (subject, data) messages, flushing once all have been sent
+        """
+        await publish(self.nc, messages)
@@ -179,11 +179,28 @@ class Job(BaseModel):
     )
 
 
+class JobBatch(BaseModel):
+    """
+    Batch of jobs, either a list of jobs or a template job with sets of parameters which
+    are substituted into the commands and environment variables of its tasks
+    """
+    jobs: Optional[List[Job]] = Field(None, title="jobs", description="List of jobs")
+    template: Optional[Job] = Field(
+        None, title="template", description="Template job, with parameters referenced as $name or ${name}"
+    )
+    parameters: Optional[List[Dict[str, str]]] = Field(
+        None, title="parameters", description="Parameter sets, one job is created for each"
+    )
+
+
 class JobOutput(Job):
     """
     Job description after submission
     """
     id: str = Field(..., title="id", description="Job id")
+    group: Optional[str] = Field(
+        None, title="group", description="Id of the batch the job was submitted in"
+    )
     status: JobStatus = Field(..., title="status", description="Job status")
     events: Optional[List[Event]] = Field([], title="events", description="Job events")
     execution: Optional[Execution] = Field(
@@ -0,0 +1,161 @@
+"""Partitioning of jobs between matchers"""
+import asyncio
+import logging
+import math
+import os
+import socket
+import time
+import zlib
+
+import nats
+
+logger = logging.getLogger(__name__)
+
+# Jobs are stored with a shard number, and each partition owns the shards which are
+# equal to it modulo the number of partitions
+SHARDS = 1024
+
+def shard(id):
+    """
+    Return the shard of a job id
+    """
+    return zlib.crc32(id.encode('utf-8')) % SHARDS
+
+def partition(job, partitions):
+    """
+    Return the partition of a job from its stored shard. Jobs stored without a shard belong
+    to partition 0, as in Database.get_pending_jobs
+    """
+    return (job.get('shard') or 0) % partitions
+
+async def leases_bucket(js, bucket, ttl):
+    """
+    Return the bucket holding partition leases, creating it if necessary. Entries expire
+    if they are not renewed within the TTL
+    """
+    try:
+        return await js.key_value(bucket)
+    except nats.js.errors.BucketNotFoundError:
+        return await js.create_key_value(bucket=bucket, ttl=ttl)
+
+class PartitionLeases(object):
+    """
+    Ownership of partitions by matchers, coordinated through leases in a NATS KV bucket.
+    Each matcher registers itself, takes an equal share of the partitions and renews its
+    leases using compare-and-set on their revisions, so a lease which has expired and
+    been taken by another matcher is never renewed
+    """
+    def __init__(self, kv, partitions, ttl):
+        self._kv = kv
+        self._partitions = partitions
+        self._ttl = ttl
+        self._id = f"{socket.gethostname()}-{os.getpid()}"
+        self._owned = {}
+        self._renewed = None
+        self.changed = asyncio.Event()
+
+    @property
+    def owned(self):
+        """
+        Partitions currently owned
+        """
+        return sorted(self._owned)
+
+    @property
+    def partitions(self):
+        """
+        Total number of partitions
+        """
+        return self._partitions
+
+    def held(self):
+        """
+        Return True if the leases were renewed recently enough that they will not expire for
+        at least a third of the TTL, leaving time to act on the partitions owned
+        """
+        return self._renewed is not None and time.monotonic() - self._renewed < self._ttl*2/3
+
+    def owns(self, job):
+        """
+        Return True if the partition of a job is owned
+        """
+        return partition(job, self._partitions) in self._owned
+
+    async def _instances(self):
+        """
+        Return the number of matchers which are running
+        """
+        try:
+            return len(await self._kv.keys(filters=['instance.>']))
+        except nats.js.errors.NoKeysError:
+            return 1
+
+    async def renew(self):
+        """
+        Register this matcher, renew the leases it owns, and acquire or release leases so
+        that it owns its share of the partitions
+        """
+        before = set(self._owned)
+        started = time.monotonic()
+        await self._kv.put(f"instance.{self._id}", self._id.encode('utf-8'))
+
+        for number, revision in list(self._owned.items()):
+            try:
+                self._owned[number] = await self._kv.update(f"partition.{number}",
+                                                            self._id.encode('utf-8'),
+                                                            last=revision)
+            except Exception as err:
+                logger.error('Lost lease on partition %d: %s', number, str(err))
+                del self._owned[number]
+
+        target = math.ceil(self._partitions/max(await self._instances(), 1))
+        while len(self._owned) > target:
+            number = max(self._owned)
+            revision = self._owned.pop(number)
+            try:
+                await self._kv.delete(f"partition.{number}", last=revision)
+            except Exception as err:
+                logger.error('Got exception releasing partition %d: %s', number, str(err))
+
+        for number in range(self._partitions):
+            if len(self._owned) >= target:
+                break
+            if number in self._owned:
+                continue
+            try:
+                self._owned[number] = await self._kv.create(f"partition.{number}", self._id.encode('utf-8'))
+            except nats.js.errors.KeyWrongLastSequenceError:
+                pass
+
+        self._renewed = started
+
+        if set(self._owned) != before:
+            logger.info('Now own partitions %s of %d', ', '.join(map(str, self.owned)), self._partitions)
+            self.changed.set()
+
+    async def renew_periodically(self):
+        """
+        Renew leases well within their TTL
+        """
+        while True:
+            await asyncio.sleep(self._ttl/3)
+            try:
+                await self.renew()
+            except Exception as err:
+                logger.error('Got exception renewing leases: %s', str(err))
+
+    async def release(self):
+        """
+        Release all leases so that other matchers can take over immediately
+        """
+        for number, revision in list(self._owned.items()):
+            try:
+                await self._kv.delete(f"partition.{number}", last=revision)
+            except Exception:
+                pass
+        self._owned = {}
+        self._renewed = None
+        try:
+            await self._kv.delete(f"instance.{self._id}")
+        except Exception:
+            pass
@@ -0,0 +1,584 @@
+"""Placement of jobs onto workers"""
+import bisect
+
+def job_priority(job):
+    """
+    Return the priority of a job
+    """
+    if job.get('policies'):
+        return job['policies'].get('priority') or 0
+    return 0
+
+def order_jobs(jobs):
+    """
+    Order jobs by decreasing priority, keeping arrival order for equal priorities
+    """
+    return sorted(jobs, key=lambda job: -job_priority(job))
+
+def resources_key(resources):
+    """
+    Return the resources required by a job as a tuple
+    """
+    return (resources['cpus'], resources['memory'], resources['disk'])
+
+def job_nodes(job):
+    """
+    Return the number of nodes, each on a different worker, required by a job
+    """
+    return job['resources'].get('nodes') or 1
+
+def job_walltime(job):
+    """
+    Return the maximum run time of a job in seconds, or None if it is not limited
+    """
+    if job['resources'].get('walltime'):
+        return job['resources']['walltime']*60
+    return None
+
+def job_images(job):
+    """
+    Return the distinct images used by the tasks of a job, in task order
+    """
+    images = []
+    for task in job.get('tasks') or []:
+        if task.get('image') and task['image'] not in images:
+            images.append(task['image'])
+    return images
+
+class RankTree(object):
+    """
+    Workers in the order in which they were first added, in a tree holding the most free
+    cpus, memory and disk of any worker in each range of them. Ranges in which no worker
+    could run a job are skipped, so the first workers able to run it are found without
+    checking every worker. The tree is rebuilt when workers are added or removed
+    """
+    def __init__(self):
+        self._ranks = {}
+        self._free = {}
+        self._slots = None
+        self._names = []
+        self._size = 0
+        self._tree = []
+
+    def set(self, name, rank, free):
+        """
+        Add a worker with the given rank, or update its free resources
+        """
+        if name not in self._ranks:
+            self._ranks[name] = rank
+            self._slots = None
+        self._free[name] = free
+        if self._slots is not None:
+            node = self._size + self._slots[name]
+            self._tree[node] = free
+            node //= 2
+            while node:
+                left = self._tree[2*node]
+                right = self._tree[2*node + 1]
+                self._tree[node] = (max(left[0], right[0]), max(left[1], right[1]), max(left[2], right[2]))
+                node //= 2
+
+    def remove(self, name):
+        """
+        Remove a worker
+        """
+        del self._ranks[name]
+        del self._free[name]
+        self._slots = None
+
+    def _build(self):
+        self._names = sorted(self._ranks, key=self._ranks.get)
+        self._slots = {name: slot for slot, name in enumerate(self._names)}
+        self._size = 1
+        while self._size < len(self._names):
+            self._size *= 2
+        empty = (float('-inf'),)*3
+        self._tree = [empty]*(2*self._size)
+        for slot, name in enumerate(self._names):
+            self._tree[self._size + slot] = self._free[name]
+        for node in range(self._size - 1, 0, -1):
+            left = self._tree[2*node]
+            right = self._tree[2*node + 1]
+            self._tree[node] = (max(left[0], right[0]), max(left[1], right[1]), max(left[2], right[2]))
+
+    def matching(self, required):
+        """
+        Generate the names of workers with at least the required (cpus, memory, disk)
+        free, in order of rank
+        """
+        if self._slots is None:
+            self._build()
+        if not self._names:
+            return
+        cpus, memory, disk = required
+        stack = [1]
+        while stack:
+            node = stack.pop()
+            free = self._tree[node]
+            if free[0] < cpus or free[1] < memory or free[2] < disk:
+                continue
+            if node >= self._size:
+                yield self._names[node - self._size]
+            else:
+                stack.append(2*node + 1)
+                stack.append(2*node)
+
+class WorkerIndex(object):
+    """
+    Workers indexed by their free resources. Entries are kept sorted by free cpus, memory
+    and disk so that the workers able to run a job can be found with a binary search.
+    Workers holding each cached image are also kept in their own sorted list. For first-fit
+    placement workers are also kept in order of when they were added
+    """
+    def __init__(self):
+        self._entries = []
+        self._available = {}
+        self._order = {}
+        self._images = {}
+        self._image_entries = {}
+        self._ranked = RankTree()
+        self._image_ranked = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _entry(self, name):
+        return resources_key(self._available[name]) + (name,)
+
+    def _lists(self, name):
+        """
+        Return the sorted lists containing the entry of a worker
+        """
+        return [self._entries] + [self._image_entries[image] for image in self._images[name]]
+
+    def _trees(self, name):
+        """
+        Return the rank trees containing a worker
+        """
+        return [self._ranked] + [self._image_ranked[image] for image in self._images[name]]
+
+    def add(self, name, available, images=None):
+        """
+        Add a worker, optionally with the images it has cached. The available resources
+        dict is updated in place as jobs are allocated
+        """
+        if name in self._available:
+            self.remove(name)
+        self._available[name] = available
+        self._images[name] = set(images or ())
+        self._order.setdefault(name, len(self._order))
+        for image in self._images[name]:
+            self._image_entries.setdefault(image, [])
+            self._image_ranked.setdefault(image, RankTree())
+        entry = self._entry(name)
+        for entries in self._lists(name):
+            bisect.insort(entries, entry)
+        for tree in self._trees(name):
+            tree.set(name, self._order[name], entry[:3])
+
+    def remove(self, name):
+        """
+        Remove a worker
+        """
+        entry = self._entry(name)
+        for entries in self._lists(name):
+            del entries[bisect.bisect_left(entries, entry)]
+        for tree in self._trees(name):
+            tree.remove(name)
+        del self._available[name]
+        del self._images[name]
+
+    def has_image(self, name, image):
+        """
+        Return True if a worker has an image cached
+        """
+        return image in self._images[name]
+
+    def allocate(self, name, resources):
+        """
+        Reduce the free resources of a worker by the resources of a job
+        """
+        self._adjust(name, resources, -1)
+
+    def release(self, name, resources):
+        """
+        Return the resources of a job to a worker
+        """
+        self._adjust(name, resources, 1)
+
+    def _adjust(self, name, resources, sign):
+        lists = self._lists(name)
+        entry = self._entry(name)
+        for entries in lists:
+            del entries[bisect.bisect_left(entries, entry)]
+        available = self._available[name]
+        for resource in ('cpus', 'memory', 'disk'):
+            available[resource] += sign*resources[resource]
+        entry = self._entry(name)
+        for entries in lists:
+            bisect.insort(entries, entry)
+        for tree in self._trees(name):
+            tree.set(name, self._order[name], entry[:3])
+
+    def candidates(self, resources, reverse=False, image=None):
+        """
+        Generate the names of workers with enough free resources for a job, in order of
+        increasing (or decreasing) free resources, optionally only those with an image cached
+        """
+        entries = self._entries
+        if image is not None:
+            entries = self._image_entries.get(image, [])
+        cpus, memory, disk = resources_key(resources)
+        start = bisect.bisect_left(entries, (cpus, memory, disk))
+        if reverse:
+            positions = range(len(entries) - 1, start - 1, -1)
+        else:
+            positions = range(start, len(entries))
+        for position in positions:
+            entry = entries[position]
+            if entry[1] >= memory and entry[2] >= disk:
+                yield entry[3]
+
+    def ranked_candidates(self, resources, image=None):
+        """
+        Generate the names of workers with enough free resources for a job, in the order
+        in which they were first added, optionally only those with an image cached
+        """
+        tree = self._ranked
+        if image is not None:
+            tree = self._image_ranked.get(image)
+            if tree is None:
+                return iter(())
+        return tree.matching(resources_key(resources))
+
+    def find(self, resources, strategy='best-fit', images=None):
+        """
+        Return the name of the worker to place a job on using the given strategy, or None.
+        If images are given, workers with the first of them cached are preferred, then
+        workers with the next, falling back to any worker with enough free resources
+        """
+        for image in images or ():
+            name = STRATEGIES[strategy](self, resources, image)
+            if name is not None:
+                return name
+        return STRATEGIES[strategy](self, resources)
+
+    def ordered_candidates(self, resources, strategy='best-fit', exclude=()):
+        """
+        Generate the names of workers with enough free resources for a job, in the order
+        the given strategy would use them, skipping any excluded workers
+        """
+        if strategy == 'first-fit':
+            names = self.ranked_candidates(resources)
+        else:
+            names = self.candidates(resources, reverse=strategy in ('worst-fit', 'spread'))
+        for name in names:
+            if name not in exclude:
+                yield name
+
+    def find_many(self, resources, count, strategy='best-fit', images=None, exclude=()):
+        """
+        Return the names of the given number of different workers, each with enough free
+        resources for one node of a job, or None if there are not enough
+        """
+        if count == 1 and not exclude:
+            name = self.find(resources, strategy, images)
+            if name is None:
+                return None
+            return [name]
+
+        names = []
+        for name in self.ordered_candidates(resources, strategy, exclude):
+            names.append(name)
+            if len(names) == count:
+                return names
+        return None
+
+    def available(self):
+        """
+        Return the free resources of each worker
+        """
+        return self._available
+
+class TieredWorkerIndex(object):
+    """
+    Workers split into tiers, where workers in a later tier are only used for a job if no
+    worker in an earlier tier can run it
+    """
+    def __init__(self, tiers=2):
+        self._indexes = [WorkerIndex() for _ in range(tiers)]
+        self._tiers = {}
+
+    def __len__(self):
+        return len(self._tiers)
+
+    def add(self, name, available, images=None, tier=0):
+        """
+        Add a worker to a tier
+        """
+        if name in self._tiers:
+            self.remove(name)
+        self._tiers[name] = tier
+        self._indexes[tier].add(name, available, images)
+
+    def remove(self, name):
+        """
+        Remove a worker
+        """
+        self._indexes[self._tiers.pop(name)].remove(name)
+
+    def has_image(self, name, image):
+        """
+        Return True if a worker has an image cached
+        """
+        return self._indexes[self._tiers[name]].has_image(name, image)
+
+    def allocate(self, name, resources):
+        """
+        Reduce the free resources of a worker by the resources of a job
+        """
+        self._indexes[self._tiers[name]].allocate(name, resources)
+
+    def release(self, name, resources):
+        """
+        Return the resources of a job to a worker
+        """
+        self._indexes[self._tiers[name]].release(name, resources)
+
+    def find(self, resources, strategy='best-fit', images=None):
+        """
+        Return the name of the worker to place a job on, from the earliest tier with a
+        worker able to run it, or None
+        """
+        for index in self._indexes:
+            name = index.find(resources, strategy, images)
+            if name is not None:
+                return name
+        return None
+
+    def find_many(self, resources, count, strategy='best-fit', images=None, exclude=()):
+        """
+        Return the names of the given number of different workers, each with enough free
+        resources for one node of a job, preferring to use workers from a single tier, or
+        None if there are not enough
+        """
+        for index in self._indexes:
+            names = index.find_many(resources, count, strategy, images, exclude)
+            if names:
+                return names
+
+        names = []
+        for index in self._indexes:
+            for name in index.ordered_candidates(resources, strategy, exclude):
+                names.append(name)
+                if len(names) == count:
+                    return names
+        return None
+
+    def available(self):
+        """
+        Return the free resources of each worker
+        """
+        available = {}
+        for index in self._indexes:
+            available.update(index.available())
+        return available
+
+def first_fit(index, resources, image=None):
+    """
+    Place onto the first worker added which has enough free resources
+    """
+    return next(index.ranked_candidates(resources, image=image), None)
+
+def best_fit(index, resources, image=None):
+    """
+    Place onto the worker with the least free resources which can run the job
+    """
+    return next(index.candidates(resources, image=image), None)
+
+def worst_fit(index, resources, image=None):
+    """
+    Place onto the worker with the most free resources, spreading jobs across workers
+    """
+    return next(index.candidates(resources, reverse=True, image=image), None)
+
+STRATEGIES = {
+    'first-fit': first_fit,
+    'best-fit': best_fit,
+    'worst-fit': worst_fit,
+    'spread': worst_fit,
+}
+
+class AvailabilityProfile(object):
+    """
+    Free resources of each worker over time, starting from what is free now and changing
+    as running jobs end and as reserved jobs start and end. Used for backfilling, so that
+    jobs are only started now if they would not delay any reserved job
+    """
+    def __init__(self, available, releases, now):
+        self._available = available
+        self._now = now
+        self._changes = {}
+        self._floors = {}
+        self._reserved = set()
+        for time, name, resources in releases:
+            if name in available:
+                # Jobs which have overrun their walltime could end at any moment
+                self._change(name, max(time, now), resources, 1)
+
+    def _change(self, name, time, resources, sign):
+        bisect.insort(self._changes.setdefault(name, []),
+                      (time, tuple(sign*value for value in resources_key(resources))))
+        self._floors.pop(name, None)
+
+    def _steps(self, name, start):
+        """
+        Generate the times from the given time onwards at which the free resources of a
+        worker change, with the free resources from then on. Changes at the same time
+        are applied together
+        """
+        free = list(resources_key(self._available[name]))
+        changes = self._changes.get(name, ())
+        position = 0
+        while position < len(changes) and changes[position][0] <= start:
+            free = [free[i] + changes[position][1][i] for i in range(3)]
+            position += 1
+        yield start, free
+        while position < len(changes):
+            time = changes[position][0]
+            while position < len(changes) and changes[position][0] == time:
+                free = [free[i] + changes[position][1][i] for i in range(3)]
+                position += 1
+            yield time, free
+
+    def _fits(self, name, required, start, end):
+        """
+        Return True if a worker has the required resources free from start until end
+        """
+        for time, free in self._steps(name, start):
+            if time >= end:
+                break
+            if any(free[i] < required[i] for i in range(3)):
+                return False
+        return True
+
+    def _floor(self, name):
+        """
+        Return the times at which the free resources of a worker change after now, and
+        the least free resources from now until each of them
+        """
+        if name not in self._floors:
+            times = []
+            floors = []
+            lowest = None
+            for time, free in self._steps(name, self._now):
+                if lowest is not None:
+                    times.append(time)
+                    floors.append(lowest)
+                lowest = free if lowest is None else [min(lowest[i], free[i]) for i in range(3)]
+            times.append(float('inf'))
+            floors.append(lowest)
+            self._floors[name] = (times, floors)
+        return self._floors[name]
+
+    def reserved(self):
+        """
+        Return the names of the workers with reservations
+        """
+        return self._reserved
+
+    def can_start(self, name, resources, end):
+        """
+        Return True if a job could start on a worker now and run until the given time
+        without taking resources reserved for another job
+        """
+        times, floors = self._floor(name)
+        floor = floors[bisect.bisect_left(times, end)]
+        return all(floor[i] >= value for i, value in enumerate(resources_key(resources)))
+
+    def started(self, name, resources, end):
+        """
+        Record that a job has been started on a worker now, ending by the given time
+        """
+        self._floors.pop(name, None)
+        if end is not None:
+            self._change(name, end, resources, 1)
+
+    def reserve(self, job):
+        """
+        Reserve resources for a job at the earliest time at which it could start, returning
+        the workers reserved or None if it could never start. Of the workers free by then,
+        those which become free last are used so that the others can run jobs meanwhile
+        """
+        required = resources_key(job['resources'])
+        duration = job_walltime(job) or float('inf')
+        nodes = job_nodes(job)
+
+        earliest = []
+        for name in self._available:
+            for time, free in self._steps(name, self._now):
+                if all(free[i] >= required[i] for i in range(3)) and \
+                   self._fits(name, required, time, time + duration):
+                    earliest.append((time, name))
+                    break
+        earliest.sort()
+
+        for start, _ in earliest[nodes - 1:]:
+            names = [name for time, name in earliest
+                     if time <= start and self._fits(name, required, start, start + duration)]
+            if len(names) >= nodes:
+                names = names[-nodes:]
+                for name in names:
+                    self._change(name, start, job['resources'], -1)
+                    if duration != float('inf'):
+                        self._change(name, start + duration, job['resources'], 1)
+                self._reserved.update(names)
+                return names
+        return None
+
+def schedule(jobs, index, strategy='best-fit', locality=False, releases=None, now=None, reservations=1):
+    """
+    Place jobs in order of priority, allocating their resources in the index and returning
+    a dict of job ids to the workers they were placed on, one per node.
+
+    If the (time, worker, resources) released as running jobs end are given, backfilling
+    is used: the given number of highest priority jobs which cannot start are given
+    reservations at the earliest time they could start, and other jobs are only started if
+    they would not delay any of them. With one reservation this is EASY backfilling
+    """
+    assignments = {}
+    unplaceable = set()
+    profile = None
+    reserved = 0
+    if releases is not None:
+        profile = AvailabilityProfile(index.available(), releases, now)
+    for job in order_jobs(jobs):
+        # Capacity only decreases during a cycle, so if a job could not be placed
+        # neither can any other job requiring the same resources
+        required = resources_key(job['resources']) + (job_nodes(job),)
+        if required in unplaceable:
+            continue
+
+        images = job_images(job) if locality else None
+        exclude = ()
+        end = None
+        if profile is not None:
+            if job_walltime(job) is not None:
+                end = now + job_walltime(job)
+            exclude = {name for name in profile.reserved()
+                       if not profile.can_start(name, job['resources'], end or float('inf'))}
+
+        names = index.find_many(job['resources'], job_nodes(job), strategy, images, exclude)
+        if not names:
+            if not exclude:
+                unplaceable.add(required)
+            if profile is not None and reserved < reservations and profile.reserve(job):
+                reserved += 1
+            continue
+
+        for name in names:
+            index.allocate(name, job['resources'])
+            if profile is not None:
+                profile.started(name, job['resources'], end)
+        assignments[job['id']] = names
+    return assignments
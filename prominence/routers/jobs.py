@@ -1,125 +1,474 @@
 """API endpoint for managing jobs"""
 import json
+import logging
 import os
 import asyncio
+import copy
+import string
 import time
+import nats
 import shortuuid
-from fastapi import APIRouter, Body, HTTPException, status, Request
-from fastapi.responses import Response, JSONResponse
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, status, Request
+from fastapi.responses import Response, JSONResponse, ORJSONResponse, StreamingResponse
 from fastapi.encoders import jsonable_encoder
 from fastapi.responses import PlainTextResponse
 from typing import List
 
-import nats
+from prominence import logs
+from prominence.dependencies import get_db, get_log_relay, get_messaging, get_status_watcher
+from prominence.messaging import STATUS_STREAM, status_change
+from prominence.models import Job, JobBatch, JobOutput, JobStatus
+from prominence.partitions import shard
+from prominence.serialization import prune_job
+from prominence.settings import settings
 
-from prominence.models import Job, JobOutput
-from prominence.utilities import config
-import prominence.database as database
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix="/jobs",
     tags=["jobs"]
 )
 
-db = database.Database()
+async def send_deletes(messaging, jobs):
+    """
+    Send delete messages to the workers running the given jobs
+    """
+    messages = []
+    for job in jobs:
+        if job.get('execution', {}).get('worker'):
+            messages.append(("worker.job.%s" % job['execution']['worker'], {'delete': job}))
+    await messaging.publish(messages)
 
-async def send_delete(worker_id, job):
+async def send_created(messaging, jobs):
     """
-    Send delete message to worker
+    Notify the matcher about new jobs
     """
-    nc = await nats.connect(config().get('nats', 'url'))
-    data = {'delete': job}
-    data = json.dumps(data).encode('utf-8')
-    await nc.publish("worker.job.%s" % worker_id, data)
+    try:
+        await messaging.publish([("matcher.job.%s" % job['id'], job) for job in jobs] +
+                                [status_change(job['id'], job['status'], job['created']) for job in jobs])
+    except Exception as err:
+        logger.error('Got exception notifying the matcher of new jobs: %s', str(err))
 
-@router.post("/", response_description="Create a job")
-async def create_job(job: Job = Body(...)):
+async def send_status_changes(messaging, jobs):
     """
-    Create a job
+    Record the current status of the given jobs in the stream of status changes
+    """
+    try:
+        now = time.time()
+        await messaging.publish([status_change(job['id'], job['status'], now) for job in jobs])
+    except Exception as err:
+        logger.error('Got exception publishing status changes: %s', str(err))
+
+def init_job(job, group=None):
+    """
+    Add the details of a newly submitted job
     """
-    job = jsonable_encoder(job)
     job['id'] = shortuuid.uuid()
+    job['shard'] = shard(job['id'])
     job['status'] = 'pending'
+    job['created'] = time.time()
     job['events'] = []
-    job['events'].append({'time': time.time(), 'type': 'created'})
+    job['events'].append({'time': job['created'], 'type': 'created'})
     job['execution'] = {}
     job['execution']['retries'] = 0
-    db.create_job(job)
+    if group:
+        job['group'] = group
+    # Maximum time in queue is in minutes, with 0 or less meaning no limit
+    if job.get('policies') and (job['policies'].get('maximumTimeInQueue') or 0) > 0:
+        job['queueDeadline'] = job['created'] + job['policies']['maximumTimeInQueue']*60
+    return job
+
+def substitute(template, parameters):
+    """
+    Return a job created from a template by substituting parameters into the commands and
+    environment variables of its tasks
+    """
+    job = copy.deepcopy(template)
+    for task in job['tasks']:
+        if task.get('cmd'):
+            task['cmd'] = string.Template(task['cmd']).safe_substitute(parameters)
+        if task.get('env'):
+            for name, value in task['env'].items():
+                task['env'][name] = string.Template(value).safe_substitute(parameters)
+    return job
+
+@router.post("/", response_description="Create a job")
+async def create_job(job: Job = Body(...), db=Depends(get_db), messaging=Depends(get_messaging)):
+    """
+    Create a job
+    """
+    job = init_job(jsonable_encoder(job))
+    await db.create_job(job)
+    await send_created(messaging, [job])
     return JSONResponse(status_code=status.HTTP_201_CREATED, content={'id': job['id']})
 
+@router.post("/bulk", response_description="Create a batch of jobs")
+async def create_jobs(batch: JobBatch = Body(...), db=Depends(get_db), messaging=Depends(get_messaging)):
+    """
+    Create a batch of jobs, either from a list of jobs or from a template and a list of
+    parameter sets. All jobs in the batch are given the same group id
+    """
+    if batch.jobs and not batch.template and batch.parameters is None:
+        jobs = [jsonable_encoder(job) for job in batch.jobs]
+    elif batch.template and batch.parameters and not batch.jobs:
+        # The template has already been validated, and substitution only changes strings
+        template = jsonable_encoder(batch.template)
+        jobs = [substitute(template, parameters) for parameters in batch.parameters]
+    else:
+        raise HTTPException(status_code=400, detail="Either jobs or a template and parameters must be specified")
+
+    group = shortuuid.uuid()
+    for job in jobs:
+        init_job(job, group)
+    await db.create_jobs(jobs)
+    await send_created(messaging, jobs)
+    return JSONResponse(status_code=status.HTTP_201_CREATED,
+                        content={'group': group, 'ids': [job['id'] for job in jobs]})
+
 @router.get(
     "/",
     response_description="List jobs",
     response_model=List[JobOutput],
     response_model_exclude_none=True,
 )
-def list_jobs(status: str = None):
+async def list_jobs(response: Response,
+                    status: str = None,
+                    limit: int = Query(None, ge=1, description="Maximum number of jobs to return"),
+                    after: str = Query(None, description="Continuation token, return jobs after this one"),
+                    fields: str = Query(None, description="Comma-separated list of fields to return"),
+                    stream: bool = Query(False, description="Stream jobs as newline-delimited JSON"),
+                    group: str = Query(None, description="Only list jobs submitted in this batch"),
+                    db=Depends(get_db)):
     """
-    List jobs
+    List jobs, ordered by id. If limit is specified and more jobs may be available the
+    X-Continuation-Token header contains the token to pass as after to get the next page
     """
-    jobs_list = db.list_jobs(status)
+    if fields:
+        fields = [field.strip() for field in fields.split(',') if field.strip()]
+        unknown = set(fields) - set(JobOutput.__fields__)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    if stream:
+        async def generate():
+            async for job in db.stream_jobs(status, after, limit, fields, group):
+                # Internal fields such as deadlines and shards are not returned
+                yield json.dumps(job if fields else prune_job(job)) + '\n'
+        return StreamingResponse(generate(), media_type='application/x-ndjson')
+
+    jobs_list = await db.list_jobs(status, after, limit, fields, group)
+    headers = {}
+    if limit and len(jobs_list) == limit:
+        headers['X-Continuation-Token'] = jobs_list[-1]['id']
+
+    if fields:
+        return JSONResponse(content=jobs_list, headers=headers)
+    if settings().api.fast_json:
+        # Jobs from the database were validated when they were written
+        return ORJSONResponse(content=[prune_job(job) for job in jobs_list], headers=headers)
+    response.headers.update(headers)
     return jobs_list
 
+def etag(job):
+    """
+    Return the entity tag of a job
+    """
+    return f'"{job["_rev"]}"'
+
+def parse_statuses(statuses):
+    """
+    Return the set of job statuses in a comma-separated list
+    """
+    try:
+        return {JobStatus(item.strip()).value for item in statuses.split(',')}
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid status in {statuses}")
+
+async def wait_for_job(db, watcher, job, wait, until):
+    """
+    Wait until the status of a job changes, or is one of the given statuses, returning
+    the job once this happens or the timeout expires. Status changes are only published
+    after they have been written, so the job is read again just once when one matches
+    """
+    def done(new_status):
+        if until:
+            return new_status in until
+        return new_status != status
+
+    id = job['id']
+    status = job['status']
+    deadline = time.monotonic() + wait
+    async with watcher.watch(id) as changes:
+        # The status may have changed before the watch started
+        job = await db.get_job(id)
+        if not job or done(job['status']):
+            return job
+        while time.monotonic() < deadline:
+            try:
+                new_status = await asyncio.wait_for(changes.get(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                break
+            if done(new_status):
+                return await db.get_job(id)
+    return job
+
+@router.get("/statuses", response_description="Stream job status changes")
+async def stream_statuses(request: Request,
+                          status: str = Query(None, description="Comma-separated statuses to include"),
+                          prefix: str = Query(None, description="Only include jobs with ids starting with this prefix"),
+                          since: int = Query(None, ge=0, description="Resume after this sequence number"),
+                          messaging=Depends(get_messaging)):
+    """
+    Stream changes of job status as Server-Sent Events, each with its sequence number as
+    the event id. Clients can resume from where they left off using the Last-Event-ID
+    header or the since parameter. A reset event is sent if changes since then are no
+    longer available, in which case the jobs should be listed again
+    """
+    statuses = parse_statuses(status) if status else None
+    if since is None and request.headers.get('last-event-id', '').isdigit():
+        since = int(request.headers['last-event-id'])
+
+    js = messaging.nc.jetstream()
+    config = nats.js.api.ConsumerConfig(deliver_policy=nats.js.api.DeliverPolicy.NEW)
+    if since is not None:
+        config = nats.js.api.ConsumerConfig(deliver_policy=nats.js.api.DeliverPolicy.BY_START_SEQUENCE,
+                                            opt_start_seq=since + 1)
+
+    # Let the server do the filtering where possible
+    subject = 'jobstatus.>'
+    if statuses and len(statuses) == 1:
+        subject = f"jobstatus.{list(statuses)[0]}.*"
+
+    async def generate():
+        if since is not None:
+            info = await js.stream_info(STATUS_STREAM)
+            if since + 1 < info.state.first_seq:
+                yield sse('reset')
+
+        sub = await js.subscribe(subject, stream=STATUS_STREAM, ordered_consumer=True, config=config)
+        try:
+            while True:
+                try:
+                    msg = await sub.next_msg(timeout=15)
+                except nats.errors.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ': keepalive\n\n'
+                    continue
+
+                data = json.loads(msg.data.decode())
+                if statuses and data['status'] not in statuses:
+                    continue
+                if prefix and not data['id'].startswith(prefix):
+                    continue
+                yield sse('status', json.dumps(data), id=msg.metadata.sequence.stream)
+        finally:
+            await sub.unsubscribe()
+
+    return StreamingResponse(generate(),
+                             media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache'})
+
 @router.get(
     "/{id}",
     response_description="Get a single job",
     response_model=JobOutput,
     response_model_exclude_none=True
 )
-async def describe_job(id: str):
+async def describe_job(request: Request,
+                       response: Response,
+                       id: str,
+                       wait: int = Query(None, ge=0, description="Seconds to wait for the status to change"),
+                       until: str = Query(None, description="Comma-separated statuses to wait for"),
+                       db=Depends(get_db),
+                       watcher=Depends(get_status_watcher)):
     """
-    Describe a single job
+    Describe a single job, optionally waiting for its status to change
     """
-    job = db.get_job(id)
-    if job:
-        return job
-    raise HTTPException(status_code=404, detail=f"Job {id} not found")
+    job = await db.get_job(id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job {id} not found")
+
+    if until:
+        until = parse_statuses(until)
+    if wait and not (until and job['status'] in until):
+        job = await wait_for_job(db, watcher, job, min(wait, settings().api.max_wait), until)
+        if not job:
+            raise HTTPException(status_code=404, detail=f"Job {id} not found")
+
+    headers = {'ETag': etag(job)}
+    if etag(job) in [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if settings().api.fast_json:
+        return ORJSONResponse(content=prune_job(job), headers=headers)
+    response.headers.update(headers)
+    return job
+
+def sse(event, data='', id=None):
+    """
+    Format a Server-Sent Event
+    """
+    lines = ''.join(f"data: {line}\n" for line in data.split('\n'))
+    if id is not None:
+        return f"id: {id}\nevent: {event}\n{lines}\n"
+    return f"event: {event}\n{lines}\n"
+
+def follow_output(request, id, stream, db, relay):
+    """
+    Return a job's standard output or error as Server-Sent Events, first replaying what
+    has been written to disk and then relaying new output until the job finishes. Relayed
+    output is tagged with its offset in the log, so output already replayed is skipped
+    and any gap is filled from disk
+    """
+    async def replay(start, end):
+        async for data in logs.read_range(id, stream, start, end):
+            yield sse('output', data.decode(errors='replace'))
+
+    async def generate():
+        async with relay.watch(id, stream) as queue:
+            position = await asyncio.to_thread(logs.log_size, id, stream)
+            if position:
+                async for event in replay(0, position):
+                    yield event
+
+            job = await db.get_job(id)
+            if not job or job['status'] in ('completed', 'failed', 'killed', 'deleted'):
+                yield sse('end')
+                return
+
+            while True:
+                try:
+                    kind, offset, data = await asyncio.wait_for(queue.get(), 15)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ': keepalive\n\n'
+                    continue
+                if offset is not None and offset > position:
+                    async for event in replay(position, offset):
+                        yield event
+                    position = offset
+                if kind == 'end':
+                    yield sse('end')
+                    return
+                if offset + len(data) > position:
+                    yield sse('output', data[position - offset:].decode(errors='replace'))
+                    position = offset + len(data)
+
+    return StreamingResponse(generate(),
+                             media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache'})
+
+async def get_output(request, id, stream, offset, length, tail):
+    """
+    Return part or all of a job's standard output or error
+    """
+    size = await asyncio.to_thread(logs.log_size, id, stream)
+
+    status_code = 200
+    headers = {'Accept-Ranges': 'bytes', 'X-Log-Size': str(size)}
+    if 'range' in request.headers:
+        try:
+            start, end = logs.parse_range(request.headers['range'], size)
+        except logs.InvalidRange:
+            return Response(status_code=416, headers={'Content-Range': f"bytes */{size}"})
+        status_code = 206
+        headers['Content-Range'] = f"bytes {start}-{end - 1}/{size}"
+    elif tail is not None:
+        start = await asyncio.to_thread(logs.tail_offset, id, stream, tail)
+        end = size
+    else:
+        start = min(offset, size)
+        end = size
+        if length is not None:
+            end = min(start + length, size)
+
+    if start >= end:
+        return PlainTextResponse('', headers=headers)
+
+    headers['Content-Length'] = str(end - start)
+    return StreamingResponse(logs.read_range(id, stream, start, end),
+                             status_code=status_code,
+                             headers=headers,
+                             media_type='text/plain')
 
 @router.get(
     "/{id}/stdout",
     response_description="Get job stdout",
     response_class=PlainTextResponse
 )
-def get_stdout(id: str):
+async def get_stdout(request: Request,
+                     id: str,
+                     offset: int = Query(0, ge=0, description="Offset in bytes to start from"),
+                     length: int = Query(None, ge=0, description="Maximum number of bytes to return"),
+                     tail: int = Query(None, ge=0, description="Return only the last lines"),
+                     follow: bool = Query(False, description="Follow the output as Server-Sent Events"),
+                     db=Depends(get_db),
+                     relay=Depends(get_log_relay)):
     """
-    Return the job standard output
+    Return the job standard output. HTTP Range requests are supported
     """
-    filename = f"{config().get('job_logger', 'directory')}/jobs.{id}.stdout"
-
-    if os.path.exists(filename):
-        with open(filename, 'rb') as fd:
-            return fd.read()
-    else:
-        return ''
+    if follow:
+        return follow_output(request, id, 'stdout', db, relay)
+    return await get_output(request, id, 'stdout', offset, length, tail)
 
 @router.get(
     "/{id}/stderr",
     response_description="Get job stderr",
     response_class=PlainTextResponse
 )
-def get_stderr(id: str):
+async def get_stderr(request: Request,
+                     id: str,
+                     offset: int = Query(0, ge=0, description="Offset in bytes to start from"),
+                     length: int = Query(None, ge=0, description="Maximum number of bytes to return"),
+                     tail: int = Query(None, ge=0, description="Return only the last lines"),
+                     follow: bool = Query(False, description="Follow the output as Server-Sent Events"),
+                     db=Depends(get_db),
+                     relay=Depends(get_log_relay)):
     """
-    Return the job standard output
+    Return the job standard error. HTTP Range requests are supported
     """
-    filename = f"{config().get('job_logger', 'directory')}/jobs.{id}.stderr"
+    if follow:
+        return follow_output(request, id, 'stderr', db, relay)
+    return await get_output(request, id, 'stderr', offset, length, tail)
 
-    if os.path.exists(filename):
-        with open(filename, 'rb') as fd:
-            return fd.read()
-    else:
-        return ''
+@router.delete("/", response_description="Delete many jobs")
+async def delete_jobs(id: List[str] = Query(None, description="Ids of jobs to delete"),
+                      status: str = Query(None, description="Delete jobs with this status"),
+                      group: str = Query(None, description="Delete jobs submitted in this batch"),
+                      limit: int = Query(None, ge=1, description="Maximum number of jobs to delete"),
+                      db=Depends(get_db),
+                      messaging=Depends(get_messaging)):
+    """
+    Delete jobs matching the given ids, status or batch, at most [api] max_delete at a time.
+    Jobs already being deleted are not matched, so the request can be repeated until no
+    ids are returned
+    """
+    if not id and not status and not group:
+        raise HTTPException(status_code=400, detail="Ids, status or group must be specified")
+
+    limit = min(limit or settings().api.max_delete, settings().api.max_delete)
+    jobs = await db.delete_jobs(id, status, group, limit)
+    await send_status_changes(messaging, jobs)
+    try:
+        await send_deletes(messaging, jobs)
+    except nats.errors.Error:
+        raise HTTPException(status_code=503, detail="Unable to notify workers running the jobs")
+    return JSONResponse(status_code=200, content={'ids': [job['id'] for job in jobs]})
 
 @router.delete("/{id}", response_description="Delete job")
-def delete_job(id: str):
+async def delete_job(id: str, db=Depends(get_db), messaging=Depends(get_messaging)):
     """
     Delete job
     """
-    db.delete_job(id)
-    job = db.get_job(id)
+    job = await db.delete_job(id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job {id} not found")
+
+    await send_status_changes(messaging, [job])
     try:
-        worker = job['execution']['worker']
-        asyncio.run(send_delete(worker, job))
-    except:
-        return JSONResponse(status_code=400, content={})
+        await send_deletes(messaging, [job])
+    except nats.errors.Error:
+        raise HTTPException(status_code=503, detail="Unable to notify the worker running the job")
 
     return JSONResponse(status_code=200, content={})
@@ -0,0 +1,42 @@
+"""API endpoint for job metrics"""
+import asyncio
+import time
+from fastapi import APIRouter, Depends
+
+from prominence.dependencies import get_db
+from prominence.settings import settings
+
+router = APIRouter(
+    prefix="/metrics",
+    tags=["metrics"]
+)
+
+class MetricsCache(object):
+    """
+    Job metrics cached for a short time, so that frequent polling does not query the
+    database every time
+    """
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._metrics = None
+        self._time = 0
+        self._lock = asyncio.Lock()
+
+    async def get(self, db):
+        """
+        Return the job metrics, querying the database if the cached metrics have expired
+        """
+        async with self._lock:
+            if self._metrics is None or time.time() - self._time > self._ttl:
+                self._metrics = await db.metrics()
+                self._time = time.time()
+            return self._metrics
+
+cache = MetricsCache(settings().api.metrics_ttl)
+
+@router.get("/", response_description="Job metrics")
+async def get_metrics(db=Depends(get_db)):
+    """
+    Return the number of jobs in each state
+    """
+    return await cache.get(db)
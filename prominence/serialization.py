@@ -0,0 +1,44 @@
+"""Fast serialization of jobs read from the database"""
+from pydantic import BaseModel
+
+from prominence.models import JobOutput
+
+def projection(model):
+    """
+    Return the fields of a model as a dict, mapping the name of each field which is itself
+    a model (or list of models) to its own projection
+    """
+    fields = {}
+    for name, field in model.__fields__.items():
+        if isinstance(field.type_, type) and issubclass(field.type_, BaseModel):
+            fields[name] = projection(field.type_)
+        else:
+            fields[name] = None
+    return fields
+
+JOB_PROJECTION = projection(JobOutput)
+
+def prune(value, fields):
+    """
+    Keep only the fields in a projection, dropping None values
+    """
+    if isinstance(value, list):
+        return [prune(item, fields) for item in value]
+    if not isinstance(value, dict):
+        return value
+    pruned = {}
+    for name, subfields in fields.items():
+        item = value.get(name)
+        if item is None:
+            continue
+        if subfields is not None:
+            item = prune(item, subfields)
+        pruned[name] = item
+    return pruned
+
+def prune_job(job):
+    """
+    Return a job from the database in the same form as the JobOutput response model with
+    None values excluded, without validating it
+    """
+    return prune(job, JOB_PROJECTION)
@@ -0,0 +1,229 @@
+"""Configuration shared by the API and all daemons"""
+import configparser
+import dataclasses
+import logging
+import os
+import signal
+import time
+from dataclasses import dataclass, field
+
+from prominence.placement import STRATEGIES
+
+logger = logging.getLogger(__name__)
+
+# How often to check whether the configuration file has changed
+CHECK_INTERVAL = 5
+
+class SettingsError(Exception):
+    """
+    Invalid configuration
+    """
+    pass
+
+def setting(default=dataclasses.MISSING, choices=None, minimum=None):
+    """
+    Define a setting, optionally restricted to some choices or a minimum value
+    """
+    return field(default=default, metadata={'choices': choices, 'minimum': minimum})
+
+@dataclass(frozen=True)
+class WorkerSettings:
+    heartbeat_interval: int = setting(15, minimum=1)
+    database: str = setting(None)
+    site: str = setting(None)
+    region: str = setting(None)
+
+@dataclass(frozen=True)
+class DatabaseSettings:
+    username: str = setting()
+    password: str = setting()
+    database: str = setting()
+    url: str = setting('http://127.0.0.1:8529')
+    pool_size: int = setting(20, minimum=1)
+    timeout: float = setting(30.0, minimum=0)
+
+@dataclass(frozen=True)
+class ApiSettings:
+    metrics_ttl: float = setting(10.0, minimum=0)
+    fast_json: bool = setting(False)
+    max_wait: int = setting(60, minimum=0)
+    max_delete: int = setting(1000, minimum=1)
+
+@dataclass(frozen=True)
+class NatsSettings:
+    url: str = setting('nats://localhost:4222')
+    workers_bucket: str = setting('prominence-workers')
+    status_max_age: int = setting(86400, minimum=1)
+    leases_bucket: str = setting('prominence-matcher-leases')
+
+@dataclass(frozen=True)
+class MatcherSettings:
+    log: str = setting('/tmp/matcher.log')
+    interval: int = setting(15, minimum=1)
+    mode: str = setting('interval', choices=('interval', 'events'))
+    resync_interval: int = setting(300, minimum=1)
+    strategy: str = setting('best-fit', choices=tuple(STRATEGIES))
+    scheduler: str = setting('greedy', choices=('greedy', 'backfill'))
+    reservations: int = setting(1, minimum=1)
+    kv_concurrency: int = setting(64, minimum=1)
+    image_locality: bool = setting(True)
+    pull_times_interval: int = setting(600, minimum=1)
+    expiry_interval: int = setting(60, minimum=1)
+    assignment_lease: int = setting(300, minimum=1)
+    assignment_penalty: int = setting(3600, minimum=0)
+    max_requeues: int = setting(3, minimum=0)
+    partitions: int = setting(1, minimum=1)
+    lease_ttl: int = setting(30, minimum=3)
+
+@dataclass(frozen=True)
+class JobLoggerSettings:
+    directory: str = setting('/tmp')
+    log: str = setting('/tmp/job-logger-type.log')
+    max_open_files: int = setting(1000, minimum=1)
+    buffer_size: int = setting(1048576, minimum=1)
+    flush_interval: float = setting(1.0, minimum=0)
+    max_ack_pending: int = setting(1000, minimum=2)
+    segment_size: int = setting(1048576, minimum=1)
+    max_size: int = setting(1073741824, minimum=0)
+    compression_level: int = setting(6, choices=range(10))
+
+@dataclass(frozen=True)
+class WorkerHandlerSettings:
+    log: str = setting('/tmp/worker-handler.log')
+    missed_heartbeats: int = setting(3, minimum=1)
+
+@dataclass(frozen=True)
+class JobHandlerSettings:
+    log: str = setting('/tmp/job-handler.log')
+    consumer: str = setting('push', choices=('push', 'batch'))
+    batch_size: int = setting(100, minimum=1)
+    tasks: int = setting(8, minimum=1)
+    lag_interval: int = setting(60, minimum=1)
+    retry_delay: float = setting(5.0, minimum=0)
+
+@dataclass(frozen=True)
+class LoggingSettings:
+    max_bytes: int = setting(10485760, minimum=0)
+    backup_count: int = setting(10, minimum=0)
+
+@dataclass(frozen=True)
+class Settings:
+    worker: WorkerSettings
+    database: DatabaseSettings
+    api: ApiSettings
+    nats: NatsSettings
+    matcher: MatcherSettings
+    job_logger: JobLoggerSettings
+    worker_handler: WorkerHandlerSettings
+    job_handler: JobHandlerSettings
+    logging: LoggingSettings
+
+def filename():
+    """
+    Return the name of the configuration file
+    """
+    return os.environ.get('PROMINENCE_WORKER_CONFIG', '/etc/prominence/prominence.ini')
+
+def _convert(value, kind):
+    if kind is bool:
+        if value.lower() in ('1', 'true', 'yes', 'on'):
+            return True
+        if value.lower() in ('0', 'false', 'no', 'off'):
+            return False
+        raise ValueError(value)
+    return kind(value)
+
+def load(name=None):
+    """
+    Parse and validate the configuration file. Any setting can be overridden by an
+    environment variable named PROMINENCE_<SECTION>_<NAME>
+    """
+    name = name or filename()
+    parser = configparser.ConfigParser()
+    try:
+        parser.read(name)
+    except configparser.Error as err:
+        raise SettingsError(f"Unable to parse {name}: {err}")
+
+    errors = []
+    sections = {}
+    for section in dataclasses.fields(Settings):
+        values = {}
+        for item in dataclasses.fields(section.type):
+            variable = f"PROMINENCE_{section.name}_{item.name}".upper()
+            if variable in os.environ:
+                value = os.environ[variable]
+            elif parser.has_option(section.name, item.name):
+                value = parser.get(section.name, item.name)
+            elif item.default is dataclasses.MISSING:
+                errors.append(f"[{section.name}] {item.name} is required")
+                continue
+            else:
+                continue
+
+            try:
+                value = _convert(value, item.type)
+            except ValueError:
+                errors.append(f"[{section.name}] {item.name} must be of type {item.type.__name__}, not {value!r}")
+                continue
+            if item.metadata['choices'] is not None and value not in item.metadata['choices']:
+                errors.append(f"[{section.name}] {item.name} must be one of {', '.join(map(str, item.metadata['choices']))}")
+            elif item.metadata['minimum'] is not None and value < item.metadata['minimum']:
+                errors.append(f"[{section.name}] {item.name} must be at least {item.metadata['minimum']}")
+            else:
+                values[item.name] = value
+        if not errors:
+            sections[section.name] = section.type(**values)
+
+    if errors:
+        raise SettingsError(f"Invalid configuration in {name}: {'; '.join(errors)}")
+    return Settings(**sections)
+
+_settings = None
+_mtime = None
+_checked = 0
+
+def _mtime_of(name):
+    try:
+        return os.path.getmtime(name)
+    except OSError:
+        return None
+
+def reload():
+    """
+    Reload the configuration, keeping the current configuration if the new one is invalid
+    """
+    global _settings, _mtime
+    mtime = _mtime_of(filename())
+    try:
+        _settings = load()
+    except SettingsError as err:
+        logger.error('Not reloading configuration: %s', str(err))
+    _mtime = mtime
+
+def settings():
+    """
+    Return the configuration, which is parsed once and reloaded if the file changes.
+    Raises SettingsError if the configuration has not yet been loaded and is invalid
+    """
+    global _settings, _mtime, _checked
+    if _settings is None:
+        _mtime = _mtime_of(filename())
+        _settings = load()
+        _checked = time.monotonic()
+    elif time.monotonic() - _checked > CHECK_INTERVAL:
+        _checked = time.monotonic()
+        if _mtime_of(filename()) != _mtime:
+            reload()
+    return _settings
+
+def reload_on_sighup():
+    """
+    Reload the configuration when SIGHUP is received
+    """
+    try:
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload())
+    except ValueError:
+        # Signal handlers can only be set in the main thread, otherwise changes are
+        # picked up from the modification time of the file
+        pass
@@ -1,32 +1,15 @@
-import configparser
-import os
 import logging
 from logging.handlers import RotatingFileHandler
 
-def config():
-    """
-    Get configuration
-    """
-    if 'PROMINENCE_WORKER_CONFIG' in os.environ:
-        filename = os.environ['PROMINENCE_WORKER_CONFIG']
-    else:
-        filename = '/etc/prominence/prominence.ini'
-
-    try:
-        config = configparser.ConfigParser()
-        config.read(filename)
-    except:
-        return None
-
-    return config
+from prominence.settings import settings
 
 def set_logger(filename):
     """
     Setup logger
     """
     handler = RotatingFileHandler(filename,
-                                  maxBytes=int(config().get('logging', 'max_bytes')),
-                                  backupCount=int(config().get('logging', 'backup_count')))
+                                  maxBytes=settings().logging.max_bytes,
+                                  backupCount=settings().logging.backup_count)
     formatter = logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s')
     handler.setFormatter(formatter)
     logger = logging.getLogger()